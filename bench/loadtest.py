@@ -0,0 +1,394 @@
+# bench/loadtest.py - /webhook 端到端壓力測試
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+
+from mock_servers import MockConfig, MockGeminiServer, MockTelegramServer
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+
+# 指標方向：True 表示越大越好
+METRICS = {
+    "webhook_p50_ms": False,
+    "webhook_p99_ms": False,
+    "reply_p50_ms": False,
+    "reply_p99_ms": False,
+    "throughput_rps": True,
+    "replies_per_1k_tokens": True,
+    "canned_replies": False,
+    "peak_rss_mb": False,
+}
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(pct / 100 * len(values) + 0.5)) - 1))
+    return round(values[index], 2)
+
+
+def read_rss_mb(pid):
+    """讀取進程常駐內存（僅 Linux）"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+# ========== 更新生成 ==========
+class UpdateFactory:
+    """生成 Telegram update，按比例混合不同觸發類型"""
+    KINDS = {
+        "command": lambda n: f"/ask 第{n}個問題是什麼？",
+        "mention": lambda n: f"@{MockTelegramServer.BOT_USERNAME} 幫我解釋一下第{n}個概念",
+        "keyword": lambda n: f"請問這個 bot 可以做什麼 {n}",
+        "chatter": lambda n: f"大家好，今天第{n}次聊天",
+        "sticker": None,
+        "edited": None,
+    }
+
+    def __init__(self, mix, chats=20, seed=42):
+        self.mix = mix
+        self.chats = [-1000000000000 - i for i in range(chats)]
+        self.random = random.Random(seed)
+        self.update_id = 0
+        self.lock = threading.Lock()
+
+    def next(self):
+        with self.lock:
+            self.update_id += 1
+            update_id = self.update_id
+            kind = self.random.choices(list(self.mix), weights=list(self.mix.values()))[0]
+            chat_id = self.random.choice(self.chats)
+            user_id = self.random.randint(1, 500)
+
+        message = {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": "Bench Group"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+        }
+        if kind == "sticker":
+            message["sticker"] = {
+                "file_id": f"sticker{update_id}", "file_unique_id": f"s{update_id}",
+                "width": 512, "height": 512, "is_animated": False, "is_video": False, "type": "regular"
+            }
+        else:
+            # 編輯過的消息即使帶命令也不會被處理
+            message["text"] = (self.KINDS[kind] or self.KINDS["command"])(update_id)
+            if kind == "command":
+                message["entities"] = [{"type": "bot_command", "offset": 0, "length": 4}]
+
+        key = "edited_message" if kind == "edited" else "message"
+        expects_reply = kind in ("command", "mention", "keyword")
+        return {"update_id": update_id, key: message}, (str(chat_id), update_id), expects_reply
+
+
+# ========== 壓測 ==========
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.telegram = None
+        self.gemini = None
+        self.bot_processes = []
+        self.bot_url = args.bot_url
+        self.webhook_latencies = []
+        self.errors = 0
+        self.sent = {}
+        self.rss_samples = []
+        self.lock = threading.Lock()
+
+    def start_mocks(self):
+        args = self.args
+        self.telegram = MockTelegramServer(port=args.telegram_port,
+                                           config=MockConfig(args.telegram_latency, args.jitter, args.telegram_429)).start()
+        self.gemini = MockGeminiServer(port=args.gemini_port,
+                                       config=MockConfig(args.gemini_latency, args.jitter, args.gemini_429),
+                                       reply_tokens=args.gemini_reply_tokens).start()
+        print(f"模擬 Telegram: {self.telegram.url}  模擬 Gemini: {self.gemini.url}")
+
+    def spawn(self, name, port, domain=None, **extra_env):
+        env = dict(os.environ)
+        env.update({
+            "TELEGRAM_API_URL": self.telegram.url,
+            "GEMINI_API_ENDPOINT": self.gemini.url,
+            "LOG_FILE": os.path.join(RESULTS_DIR, f"{name}-bench.log"),
+        })
+        # 本地限速設得足夠高：測的是 webhook 路徑而不是 Key 池的限速，同時保留配額計數的開銷
+        env.setdefault("GEMINI_RPM", "100000")
+        env.setdefault("GEMINI_TPM", "1000000000")
+        env.update(extra_env)
+        command = [
+            sys.executable, os.path.join(ROOT_DIR, "main.py"),
+            "--token", "123456:BENCH", "--key", "bench-key", "--port", str(port)
+        ]
+        if domain:
+            command += ["--domain", domain]
+        if self.args.workers:
+            command += ["--workers", self.args.workers]
+        process = subprocess.Popen(command, cwd=RESULTS_DIR, env=env,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.bot_processes.append(process)
+        return f"http://127.0.0.1:{port}"
+
+    def start_bot(self):
+        if self.bot_url:
+            return
+        # 分片模式：N 個 worker + 1 個前門
+        if self.args.shards:
+            workers = [self.spawn(f"worker{i}", free_port(), BOT_ROLE="worker", SHARD_SECRET="bench")
+                       for i in range(self.args.shards)]
+            for url in workers:
+                self.wait_ready(url)
+            port = free_port()
+            self.bot_url = self.spawn("frontdoor", port, f"http://127.0.0.1:{port}", BOT_ROLE="frontdoor",
+                                      SHARD_NODES=",".join(workers), SHARD_SECRET="bench")
+        else:
+            port = free_port()
+            self.bot_url = self.spawn("bot", port, f"http://127.0.0.1:{port}")
+        self.wait_ready(self.bot_url)
+
+    def wait_ready(self, url, timeout=120):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            for process in self.bot_processes:
+                if process.poll() is not None:
+                    raise RuntimeError(f"機器人進程退出，代碼 {process.returncode}")
+            try:
+                if requests.get(f"{url}/health", timeout=1).status_code == 200:
+                    return
+            except requests.RequestException:
+                pass
+            time.sleep(0.5)
+        raise RuntimeError("等待機器人啟動超時")
+
+    def stop(self):
+        for process in self.bot_processes:
+            process.terminate()
+        for process in self.bot_processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if self.telegram:
+            self.telegram.stop()
+        if self.gemini:
+            self.gemini.stop()
+
+    def sample_memory(self, stop_event):
+        while not stop_event.is_set():
+            # 多進程時統計總內存（包括 --workers 產生的子進程）
+            samples = [read_rss_mb(pid) for pid in self.process_tree()]
+            samples = [rss for rss in samples if rss]
+            if samples:
+                self.rss_samples.append(sum(samples))
+            stop_event.wait(0.5)
+
+    def process_tree(self):
+        """機器人進程及其子進程的 PID（僅 Linux）"""
+        pids = [process.pid for process in self.bot_processes]
+        for pid in list(pids):
+            try:
+                with open(f"/proc/{pid}/task/{pid}/children") as f:
+                    pids.extend(int(child) for child in f.read().split())
+            except OSError:
+                pass
+        return pids
+
+    def post_update(self, session, update, key, expects_reply):
+        start = time.time()
+        try:
+            response = session.post(f"{self.bot_url}/webhook", data=json.dumps(update, ensure_ascii=False).encode("utf-8"),
+                                    headers={"Content-Type": "application/json"}, timeout=30)
+            ok = response.status_code == 200
+        except requests.RequestException:
+            ok = False
+        elapsed = (time.time() - start) * 1000
+        with self.lock:
+            if ok:
+                self.webhook_latencies.append(elapsed)
+                if expects_reply:
+                    self.sent[key] = start
+            else:
+                self.errors += 1
+
+    def run(self):
+        args = self.args
+        factory = UpdateFactory(parse_mix(args.mix), chats=args.chats)
+        session = requests.Session()
+        session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=args.concurrency))
+
+        stop_event = threading.Event()
+        sampler = threading.Thread(target=self.sample_memory, args=(stop_event,), daemon=True)
+        sampler.start()
+
+        total = int(args.rps * args.duration)
+        interval = 1.0 / args.rps
+        started = time.time()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            for index in range(total):
+                # 開環調度：按目標速率發送，不等待上一個請求完成
+                target = started + index * interval
+                delay = target - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                update, key, expects_reply = factory.next()
+                pool.submit(self.post_update, session, update, key, expects_reply)
+        send_elapsed = time.time() - started
+
+        # 等待回覆到達
+        deadline = time.time() + args.drain
+        while time.time() < deadline:
+            with self.telegram.state.lock:
+                pending = [key for key in self.sent
+                           if key not in self.telegram.state.replies and key not in self.telegram.state.canned]
+            if not pending:
+                break
+            time.sleep(0.2)
+        stop_event.set()
+        sampler.join()
+        return self.report(total, send_elapsed)
+
+    def report(self, total, send_elapsed):
+        replies = self.telegram.state.replies
+        reply_latencies = [(replies[key] - sent) * 1000 for key, sent in self.sent.items() if key in replies]
+        completed = len(self.webhook_latencies)
+        gemini_tokens = sum(self.gemini.state.tokens.values())
+        return {
+            "label": self.args.label,
+            "timestamp": datetime.now().isoformat(),
+            "params": {
+                "rps": self.args.rps, "duration": self.args.duration, "mix": self.args.mix,
+                "gemini_latency": self.args.gemini_latency, "telegram_latency": self.args.telegram_latency,
+                "gemini_429": self.args.gemini_429, "telegram_429": self.args.telegram_429,
+                "gemini_reply_tokens": self.args.gemini_reply_tokens,
+                "shards": self.args.shards, "workers": self.args.workers
+            },
+            "requests": total,
+            "errors": self.errors,
+            "throughput_rps": round(completed / send_elapsed, 2) if send_elapsed else None,
+            "webhook_p50_ms": percentile(self.webhook_latencies, 50),
+            "webhook_p99_ms": percentile(self.webhook_latencies, 99),
+            "expected_replies": len(self.sent),
+            "replies": len(reply_latencies),
+            "reply_p50_ms": percentile(reply_latencies, 50),
+            "reply_p99_ms": percentile(reply_latencies, 99),
+            # 忙碌/失敗/冷卻等固定回覆，不計入回覆數和延遲
+            "canned_replies": sum(self.telegram.state.canned_counts.values()),
+            "canned_by_kind": dict(self.telegram.state.canned_counts),
+            "gemini_tokens": gemini_tokens,
+            "replies_per_1k_tokens": round(len(reply_latencies) * 1000 / gemini_tokens, 2) if gemini_tokens else None,
+            "peak_rss_mb": round(max(self.rss_samples), 1) if self.rss_samples else None,
+            "end_rss_mb": round(self.rss_samples[-1], 1) if self.rss_samples else None,
+            "telegram_calls": dict(self.telegram.state.calls),
+            "gemini_calls": dict(self.gemini.state.calls),
+        }
+
+
+def parse_mix(text):
+    """解析 'command=3,keyword=2,chatter=5' 形式的比例"""
+    mix = {}
+    for item in text.split(","):
+        name, _, weight = item.partition("=")
+        name = name.strip()
+        if name not in UpdateFactory.KINDS:
+            raise ValueError(f"未知類型: {name}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def save_result(result):
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    name = f"{result['label']}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    path = os.path.join(RESULTS_DIR, name)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2, ensure_ascii=False)
+    return path
+
+
+def compare(result, baseline_path, tolerance):
+    """與基準結果比較，返回是否出現回歸"""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+
+    regressed = False
+    print(f"\n對比基準: {baseline_path}")
+    for metric, higher_is_better in METRICS.items():
+        old, new = baseline.get(metric), result.get(metric)
+        if old is None or new is None or old == 0:
+            continue
+        change = (new - old) / old
+        worse = change < -tolerance if higher_is_better else change > tolerance
+        regressed = regressed or worse
+        print(f"  {metric:16} {old:>10} -> {new:>10}  ({change:+.1%}){'  ⚠ 回歸' if worse else ''}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Telegram Gemini Bot webhook 壓力測試")
+    parser.add_argument("--label", default="baseline", help="結果名稱")
+    parser.add_argument("--rps", type=float, default=20, help="目標每秒請求數")
+    parser.add_argument("--duration", type=float, default=30, help="發送時長（秒）")
+    parser.add_argument("--concurrency", type=int, default=64, help="客戶端並發連接數")
+    parser.add_argument("--chats", type=int, default=20, help="模擬群組數量")
+    parser.add_argument("--mix", default="command=2,mention=1,keyword=2,chatter=4,sticker=1,edited=1",
+                        help="更新類型比例")
+    parser.add_argument("--drain", type=float, default=30, help="發送完畢後等待回覆的時間（秒）")
+    parser.add_argument("--telegram-latency", type=float, default=20, help="Telegram 延遲 (ms)")
+    parser.add_argument("--gemini-latency", type=float, default=400, help="Gemini 延遲 (ms)")
+    parser.add_argument("--jitter", type=float, default=50, help="隨機抖動 (ms)")
+    parser.add_argument("--telegram-429", type=float, default=0.0, help="Telegram 429 比例")
+    parser.add_argument("--gemini-429", type=float, default=0.0, help="Gemini 429 比例")
+    parser.add_argument("--gemini-reply-tokens", type=int, default=120,
+                        help="模擬回答長度（token），受請求的 maxOutputTokens 限制")
+    parser.add_argument("--telegram-port", type=int, default=0, help="模擬 Telegram 端口（0 為隨機）")
+    parser.add_argument("--gemini-port", type=int, default=0, help="模擬 Gemini 端口（0 為隨機）")
+    parser.add_argument("--shards", type=int, default=0, help="啟動 N 個分片節點和一個前門（0 為單進程）")
+    parser.add_argument("--workers", help="傳給 main.py 的 --workers（多進程 SO_REUSEPORT）")
+    parser.add_argument("--bot-url", help="使用已啟動的機器人（需指向上面兩個模擬端口），而不是自動啟動 main.py")
+    parser.add_argument("--compare", help="與指定的歷史結果比較")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="回歸判定閾值")
+    args = parser.parse_args()
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    test = LoadTest(args)
+    try:
+        test.start_mocks()
+        test.start_bot()
+        result = test.run()
+    finally:
+        test.stop()
+
+    path = save_result(result)
+    print(json.dumps({k: v for k, v in result.items() if not k.endswith("_calls")}, indent=2, ensure_ascii=False))
+    print(f"\n結果已保存: {path}")
+
+    if args.compare and compare(result, args.compare, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
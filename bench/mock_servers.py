@@ -0,0 +1,395 @@
+# bench/mock_servers.py - 本地模擬 Telegram Bot API 和 Gemini API
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class MockConfig:
+    """模擬服務器行為配置"""
+    def __init__(self, latency_ms=0, jitter_ms=0, error_rate=0.0):
+        self.latency_ms = latency_ms  # 基礎延遲
+        self.jitter_ms = jitter_ms    # 隨機抖動
+        self.error_rate = error_rate  # 429 注入比例
+
+    def delay(self):
+        latency = self.latency_ms + random.uniform(0, self.jitter_ms)
+        if latency > 0:
+            time.sleep(latency / 1000)
+
+    def should_fail(self):
+        return self.error_rate > 0 and random.random() < self.error_rate
+
+
+class _BaseHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle(self):
+        # 客戶端（機器人進程）被終止時不打印堆棧
+        try:
+            super().handle()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def read_params(self):
+        """合併 query string、表單和 JSON 參數"""
+        parsed = urlparse(self.path)
+        params = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            body = self.rfile.read(length)
+            content_type = self.headers.get("Content-Type", "")
+            if "json" in content_type:
+                try:
+                    params.update(json.loads(body))
+                except ValueError:
+                    pass
+            elif "x-www-form-urlencoded" in content_type:
+                params.update({k: v[0] for k, v in parse_qs(body.decode("utf-8")).items()})
+        return parsed.path, params
+
+    def send_json(self, payload, status=200):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+# ========== Telegram Bot API ==========
+class TelegramHandler(_BaseHandler):
+    server_version = "MockTelegram/1.0"
+
+    def do_GET(self):
+        self.handle_method()
+
+    def do_POST(self):
+        self.handle_method()
+
+    def handle_method(self):
+        path, params = self.read_params()
+        if path.startswith("/file/bot"):
+            self.send_file()
+            return
+        match = re.match(r"^/bot([^/]+)/(\w+)$", path)
+        if not match:
+            self.send_json({"ok": False, "error_code": 404, "description": "Not Found"}, 404)
+            return
+
+        state = self.server.state
+        method = match.group(2)
+        state.config.delay()
+
+        if state.config.should_fail() and method in ("sendMessage", "deleteMessage"):
+            state.record(method, params, status=429)
+            self.send_json({
+                "ok": False,
+                "error_code": 429,
+                "description": "Too Many Requests: retry after 1",
+                "parameters": {"retry_after": 1}
+            }, 429)
+            return
+
+        handler = getattr(self, f"api_{method}", None)
+        result = handler(params) if handler else True
+        state.record(method, params)
+        self.send_json({"ok": True, "result": result})
+
+    def api_getMe(self, params):
+        return {
+            "id": MockTelegramServer.BOT_ID,
+            "is_bot": True,
+            "first_name": "Bench Bot",
+            "username": MockTelegramServer.BOT_USERNAME
+        }
+
+    def api_sendMessage(self, params):
+        state = self.server.state
+        chat_id = int(params.get("chat_id", 0))
+        return {
+            "message_id": state.next_message_id(),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "group" if chat_id < 0 else "private"},
+            "from": self.api_getMe(params),
+            "text": params.get("text", "")
+        }
+
+    def api_getChatMember(self, params):
+        user_id = int(params.get("user_id", 0))
+        status = "administrator" if user_id in self.server.state.admins else "member"
+        return {"user": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}, "status": status}
+
+    def api_getFile(self, params):
+        file_id = params.get("file_id", "")
+        return {"file_id": file_id, "file_unique_id": file_id[-16:], "file_size": self.server.state.file_bytes,
+                "file_path": f"photos/{file_id}.jpg"}
+
+    def send_file(self):
+        state = self.server.state
+        state.config.delay()
+        state.record("file", {})
+        body = (b"\xff\xd8\xff\xe0" + b"\x00" * state.file_bytes)[:state.file_bytes]
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def api_getWebhookInfo(self, params):
+        return {"url": self.server.state.webhook_url or "", "has_custom_certificate": False, "pending_update_count": 0}
+
+    def api_setWebhook(self, params):
+        self.server.state.webhook_url = params.get("url")
+        return True
+
+    def api_deleteWebhook(self, params):
+        self.server.state.webhook_url = None
+        return True
+
+
+class TelegramState:
+    # 機器人的固定回覆（忙碌、失敗、冷卻提示），不算作真正的回答
+    CANNED_REPLIES = (
+        ("busy", "🚦 目前請求較多"),
+        ("failure", "抱歉，AI服務暫時不可用"),
+        ("failure", "抱歉，消息發送出錯"),
+        ("error", "⚠️ 處理消息時出錯"),
+        ("cooldown", "請等待 "),
+    )
+
+    def __init__(self, config, file_bytes=64 * 1024):
+        self.config = config
+        self.file_bytes = file_bytes  # getFile 下載返回的文件大小
+        self.lock = threading.Lock()
+        self.message_id = 1000000
+        self.webhook_url = None
+        self.admins = set()  # getChatMember 返回 administrator 的用戶
+        self.calls = {}
+        self.replies = {}  # reply_to_message_id -> 收到最終回覆的時間
+        self.canned = {}  # reply_to_message_id -> 收到固定回覆的時間
+        self.canned_counts = {}  # 固定回覆類型 -> 次數
+
+    def next_message_id(self):
+        with self.lock:
+            self.message_id += 1
+            return self.message_id
+
+    def record(self, method, params, status=200):
+        now = time.time()
+        with self.lock:
+            key = method if status == 200 else f"{method}:{status}"
+            self.calls[key] = self.calls.get(key, 0) + 1
+
+            if method != "sendMessage" or status != 200:
+                return
+            # 忽略"思考中"之類的臨時消息，只記錄最終回覆
+            text = str(params.get("text", ""))
+            if text.startswith("🤔"):
+                return
+            canned = next((kind for kind, prefix in self.CANNED_REPLIES if text.startswith(prefix)), None)
+            reply_to = params.get("reply_to_message_id")
+            if reply_to is None and params.get("reply_parameters"):
+                reply_parameters = params["reply_parameters"]
+                if isinstance(reply_parameters, str):
+                    reply_parameters = json.loads(reply_parameters)
+                reply_to = reply_parameters.get("message_id")
+            if canned:
+                self.canned_counts[canned] = self.canned_counts.get(canned, 0) + 1
+            if reply_to is not None:
+                replies = self.canned if canned else self.replies
+                replies.setdefault((str(params.get("chat_id")), int(reply_to)), now)
+
+
+class MockTelegramServer:
+    BOT_ID = 987654321
+    BOT_USERNAME = "bench_bot"
+
+    def __init__(self, host="127.0.0.1", port=0, config=None, **state_options):
+        self.state = TelegramState(config or MockConfig(), **state_options)
+        self.httpd = ThreadingHTTPServer((host, port), TelegramHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.state = self.state
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="mock-telegram", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+# ========== Gemini generateContent ==========
+class GeminiHandler(_BaseHandler):
+    server_version = "MockGemini/1.0"
+
+    def do_POST(self):
+        path, params = self.read_params()
+        match = re.match(r"^/v1(?:beta)?/(?:models/)?([^:]+):(\w+)$", path)
+        if not match:
+            self.send_json({"error": {"code": 404, "message": "Not Found", "status": "NOT_FOUND"}}, 404)
+            return
+
+        state = self.server.state
+        model, action = match.groups()
+        state.record(model, action)
+        prompt = self.prompt_text(params)
+
+        if action == "countTokens":
+            self.send_json({"totalTokens": max(1, len(prompt) // 4)})
+            return
+
+        state.config.delay()
+        if state.config.should_fail():
+            state.record(model, f"{action}:429")
+            self.send_json({
+                "error": {"code": 429, "message": "Resource has been exhausted (e.g. check quota).", "status": "RESOURCE_EXHAUSTED"}
+            }, 429)
+            return
+
+        max_tokens = (params.get("generationConfig") or {}).get("maxOutputTokens")
+        text = state.reply_text(prompt, max_tokens)
+        state.record_tokens(model, max(1, len(prompt) // 4) + len(text))
+        if action == "streamGenerateContent":
+            self.stream(text, prompt, sse="alt=sse" in self.path)
+        else:
+            self.send_json(state.response(text, prompt))
+
+    @staticmethod
+    def prompt_text(params):
+        parts = []
+        for content in params.get("contents", []):
+            for part in content.get("parts", []):
+                if "inlineData" in part or "inline_data" in part:
+                    parts.append("[inline]")
+                parts.append(part.get("text", ""))
+        return "\n".join(parts)
+
+    def stream(self, text, prompt, sse=True):
+        state = self.server.state
+        size = max(1, len(text) // state.stream_chunks)
+        chunks = [text[i:i + size] for i in range(0, len(text), size)]
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream" if sse else "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def write(data):
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+        if not sse:
+            write(b"[")
+        for index, chunk in enumerate(chunks):
+            payload = json.dumps(state.response(chunk, prompt), ensure_ascii=False)
+            if sse:
+                write(f"data: {payload}\r\n\r\n".encode("utf-8"))
+            else:
+                write(((", " if index else "") + payload).encode("utf-8"))
+            time.sleep(state.stream_interval_ms / 1000)
+        if not sse:
+            write(b"]")
+        write(b"")
+
+
+class GeminiState:
+    def __init__(self, config, reply_tokens=120, stream_chunks=4, stream_interval_ms=20):
+        self.config = config
+        self.reply_tokens = reply_tokens
+        self.stream_chunks = stream_chunks
+        self.stream_interval_ms = stream_interval_ms
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.tokens = {}  # 模型 -> 消耗的 token（配額單位）
+
+    def record(self, model, action):
+        with self.lock:
+            key = f"{model}:{action}"
+            self.calls[key] = self.calls.get(key, 0) + 1
+
+    def record_tokens(self, model, tokens):
+        with self.lock:
+            self.tokens[model] = self.tokens.get(model, 0) + tokens
+
+    def reply_text(self, prompt, max_tokens=None):
+        tokens = min(self.reply_tokens, max_tokens or self.reply_tokens)
+        return ("這是模擬回答。" * tokens)[:tokens]
+
+    @staticmethod
+    def response(text, prompt):
+        return {
+            "candidates": [{
+                "content": {"parts": [{"text": text}], "role": "model"},
+                "finishReason": "STOP",
+                "index": 0
+            }],
+            "usageMetadata": {
+                "promptTokenCount": max(1, len(prompt) // 4),
+                "candidatesTokenCount": max(1, len(text)),
+                "totalTokenCount": max(1, len(prompt) // 4) + max(1, len(text))
+            }
+        }
+
+
+class MockGeminiServer:
+    def __init__(self, host="127.0.0.1", port=0, config=None, **state_options):
+        self.state = GeminiState(config or MockConfig(), **state_options)
+        self.httpd = ThreadingHTTPServer((host, port), GeminiHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.state = self.state
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="mock-gemini", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="本地模擬 Telegram / Gemini 服務器")
+    parser.add_argument("--telegram-port", type=int, default=18081)
+    parser.add_argument("--gemini-port", type=int, default=18082)
+    parser.add_argument("--telegram-latency", type=float, default=20, help="Telegram 延遲 (ms)")
+    parser.add_argument("--gemini-latency", type=float, default=400, help="Gemini 延遲 (ms)")
+    parser.add_argument("--jitter", type=float, default=50, help="隨機抖動 (ms)")
+    parser.add_argument("--telegram-429", type=float, default=0.0, help="Telegram 429 比例")
+    parser.add_argument("--gemini-429", type=float, default=0.0, help="Gemini 429 比例")
+    args = parser.parse_args()
+
+    telegram = MockTelegramServer(port=args.telegram_port, config=MockConfig(args.telegram_latency, args.jitter, args.telegram_429)).start()
+    gemini = MockGeminiServer(port=args.gemini_port, config=MockConfig(args.gemini_latency, args.jitter, args.gemini_429)).start()
+    print(f"Telegram: {telegram.url}")
+    print(f"Gemini:   {gemini.url}")
+    print(f"啟動機器人: TELEGRAM_API_URL={telegram.url} GEMINI_API_ENDPOINT={gemini.url} python main.py ...")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        telegram.stop()
+        gemini.stop()
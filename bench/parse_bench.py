@@ -0,0 +1,68 @@
+# bench/parse_bench.py - webhook 解析路徑基準測試（完整 Update 解析 vs 快速路徑）
+import argparse
+import json
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+DEFAULT_PAYLOADS = os.path.join(BENCH_DIR, "payloads", "updates.json")
+
+
+def load_main():
+    """以離線配置導入 main.py（不啟動服務）"""
+    os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+    os.environ.setdefault("GEMINI_API_KEY", "bench-key")
+    os.environ.setdefault("LOG_FILE", "")
+    sys.argv = [sys.argv[0]]
+    sys.path.insert(0, ROOT_DIR)
+    import main
+    import telebot
+
+    # 預置機器人身份，避免請求 getMe
+    main.bot_identity.user = telebot.types.User(id=987654321, is_bot=True, first_name="Bench Bot", username="bench_bot")
+    return main
+
+
+def bench(name, func, payloads, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for raw in payloads:
+            func(raw)
+    elapsed = time.perf_counter() - start
+    count = rounds * len(payloads)
+    print(f"{name:28} {count / elapsed:>12,.0f} 更新/秒   {elapsed / count * 1e6:>8.2f} µs/更新")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="webhook 解析基準測試")
+    parser.add_argument("--payloads", default=DEFAULT_PAYLOADS, help="抓取的 update JSON 列表")
+    parser.add_argument("--rounds", type=int, default=2000, help="重複輪數")
+    args = parser.parse_args()
+
+    bot_main = load_main()
+    with open(args.payloads, encoding="utf-8") as f:
+        payloads = [json.dumps(update, ensure_ascii=False).encode("utf-8") for update in json.load(f)]
+
+    def full_parse(raw):
+        return bot_main.telebot.types.Update.de_json(raw.decode("utf-8"))
+
+    def fast_path(raw):
+        lite = bot_main.UpdateLite.parse(raw)
+        if bot_main.message_handler.is_actionable(lite):
+            return bot_main.telebot.types.Update.de_json(lite.data)
+        return None
+
+    actionable = sum(1 for raw in payloads if fast_path(raw) is not None)
+    print(f"載入 {len(payloads)} 個更新，需要處理 {actionable} 個；JSON 解析器: "
+          f"{'orjson' if bot_main.json_loads is not json.loads else 'json'}\n")
+
+    baseline = bench("完整 Update.de_json", full_parse, payloads, args.rounds)
+    fast = bench("快速路徑 + 按需 de_json", fast_path, payloads, args.rounds)
+    print(f"\n加速: {baseline / fast:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
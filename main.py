@@ -1,8 +1,9 @@
 # main.py - 智能適配版
 import os
 import telebot
-import google.generativeai as genai
+from google.ai import generativelanguage as glm
 from flask import Flask, request, abort
+from werkzeug.serving import make_server
 import ast
 import operator
 import time
@@ -11,8 +12,32 @@ import json
 import re
 import socket
 import logging
+import logging.handlers
+import queue
+import threading
+import atexit
+import signal
+import select
 import sys
 import random
+import heapq
+import hashlib
+import bisect
+import zlib
+import io
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None  # 未安裝 Pillow 時不縮放圖片
 from datetime import datetime
 
 # ========== 智能環境檢測 ==========
@@ -92,19 +117,198 @@ def detect_environment():
             pass
         
     except Exception as e:
-        logging.warning(f"環境檢測失敗: {e}")
+        logging.warning("環境檢測失敗: %s", e)
     
     return env_info
 
 # ========== 配置和日誌 ==========
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout),
-        logging.FileHandler('bot.log', encoding='utf-8')
-    ]
-)
+class JsonFormatter(logging.Formatter):
+    """JSON 結構化日誌格式"""
+    def __init__(self, include_pid=False):
+        super().__init__()
+        self.include_pid = include_pid
+    
+    def format(self, record):
+        # 工作進程轉發過來的日誌已格式化
+        if getattr(record, "preformatted", None):
+            return record.preformatted
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage()
+        }
+        if self.include_pid:
+            entry["pid"] = record.process
+        if getattr(record, "sampled", None):
+            entry["sampled"] = record.sampled
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+class SizeTimedRotatingFileHandler(logging.handlers.TimedRotatingFileHandler):
+    """同時按時間和大小輪替的文件處理器"""
+    def __init__(self, filename, max_bytes=0, **kwargs):
+        super().__init__(filename, **kwargs)
+        self.max_bytes = max_bytes
+    
+    def shouldRollover(self, record):
+        if super().shouldRollover(record):
+            return True
+        if self.max_bytes > 0 and self.stream is not None:
+            self.stream.seek(0, 2)
+            return self.stream.tell() >= self.max_bytes
+        return False
+    
+    def doRollover(self):
+        # 到了時間點按時間輪替（bot.log.<日期>）
+        if int(time.time()) >= self.rolloverAt:
+            return super().doRollover()
+        
+        # 大小觸發：使用帶序號的文件名（bot.log.<日期>.<n>），不覆蓋當天已有的備份
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        date = time.strftime(self.suffix, time.gmtime() if self.utc else time.localtime())
+        dir_name, base_name = os.path.split(self.baseFilename)
+        prefix = f"{base_name}.{date}."
+        index = 1 + max((int(name[len(prefix):]) for name in os.listdir(dir_name)
+                         if name.startswith(prefix) and name[len(prefix):].isdigit()), default=0)
+        self.rotate(self.baseFilename, self.rotation_filename(f"{self.baseFilename}.{date}.{index}"))
+        if self.backupCount > 0:
+            for path in self.getFilesToDelete():
+                os.remove(path)
+        if not self.delay:
+            self.stream = self._open()
+    
+    def getFilesToDelete(self):
+        """按修改時間保留最新的 backupCount 個備份（包括時間和大小輪替產生的）"""
+        dir_name, base_name = os.path.split(self.baseFilename)
+        backups = [os.path.join(dir_name, name) for name in os.listdir(dir_name) if name.startswith(base_name + ".")]
+        if len(backups) <= self.backupCount:
+            return []
+        # 同一秒內的多次輪替按序號排序
+        backups.sort(key=lambda path: (os.path.getmtime(path), len(path), path))
+        return backups[:len(backups) - self.backupCount]
+
+class SamplingFilter(logging.Filter):
+    """對重複的噪音日誌進行採樣（按 logger + 消息模板計數）"""
+    def __init__(self, window=60, burst=5, every=50):
+        super().__init__()
+        self.window = window  # 統計窗口（秒）
+        self.burst = burst    # 每個窗口內完整記錄的條數
+        self.every = every    # 超出後每 N 條記錄一條
+        self.counters = {}
+        self.pruned = 0  # 上次清理過期計數的時間
+        self.lock = threading.Lock()
+    
+    def filter(self, record):
+        # 只採樣 WARNING 級別，錯誤日誌永遠保留
+        if record.levelno != logging.WARNING:
+            return True
+        
+        key = (record.name, record.msg)
+        now = record.created
+        with self.lock:
+            # 每個窗口清理一次過期計數，避免不同消息的計數無限增長
+            if now - self.pruned > self.window:
+                self.counters = {k: v for k, v in self.counters.items() if now - v[0] <= self.window}
+                self.pruned = now
+            start, count = self.counters.get(key, (now, 0))
+            if now - start > self.window:
+                start, count = now, 0
+            count += 1
+            self.counters[key] = (start, count)
+        
+        if count <= self.burst:
+            return True
+        if (count - self.burst) % self.every == 0:
+            record.sampled = count
+            return True
+        return False
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """不在請求線程格式化、隊列滿時直接丟棄的隊列處理器"""
+    dropped = 0
+    
+    def prepare(self, record):
+        # 格式化交給監聽線程，請求線程只負責入隊
+        return record
+    
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            NonBlockingQueueHandler.dropped += 1
+
+class LogForwardHandler(logging.Handler):
+    """多進程工作進程：每條日誌作為一個數據報發給主進程，由主進程統一寫文件和輪替"""
+    MAX_SIZE = 60000
+    
+    def __init__(self, fd):
+        super().__init__()
+        self.sock = socket.socket(fileno=fd)
+    
+    def emit(self, record):
+        try:
+            data = self.format(record).encode("utf-8")
+            if len(data) > self.MAX_SIZE:
+                entry = json.loads(data)
+                entry["message"] = entry["message"][:4000] + "...[截斷]"
+                if "exc_info" in entry:
+                    entry["exc_info"] = entry["exc_info"][-8000:]
+                data = json.dumps(entry, ensure_ascii=False).encode("utf-8")
+            self.sock.send(data)
+        except Exception:
+            self.handleError(record)
+
+def setup_logging():
+    """設置非阻塞日誌管線：請求線程 -> 隊列 -> 監聽線程 -> 控制台/文件"""
+    level = getattr(logging, os.getenv("LOG_LEVEL", "INFO").upper(), logging.INFO)
+    log_file = os.getenv("LOG_FILE", "bot.log")
+    
+    console = logging.StreamHandler(sys.stdout)
+    if os.getenv("LOG_FORMAT", "text").lower() == "json":
+        console.setFormatter(JsonFormatter())
+    else:
+        console.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    handlers = [console]
+    
+    if os.getenv("PREFORK_LOG_FD"):
+        # 多進程工作進程：不直接打開日誌文件，避免多個進程同時輪替
+        forward = LogForwardHandler(int(os.environ["PREFORK_LOG_FD"]))
+        forward.setFormatter(JsonFormatter(include_pid=True))
+        handlers.append(forward)
+    elif log_file:
+        file_handler = SizeTimedRotatingFileHandler(
+            log_file,
+            max_bytes=int(os.getenv("LOG_MAX_BYTES", 10 * 1024 * 1024)),
+            when=os.getenv("LOG_ROTATE_WHEN", "midnight"),
+            backupCount=int(os.getenv("LOG_BACKUP_COUNT", 7)),
+            encoding='utf-8'
+        )
+        file_handler.setFormatter(JsonFormatter())
+        handlers.append(file_handler)
+    
+    log_queue = queue.Queue(maxsize=int(os.getenv("LOG_QUEUE_SIZE", 10000)))
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(
+        window=int(os.getenv("LOG_SAMPLE_WINDOW", 60)),
+        burst=int(os.getenv("LOG_SAMPLE_BURST", 5)),
+        every=int(os.getenv("LOG_SAMPLE_EVERY", 50))
+    ))
+    
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(level)
+    
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+log_listener = setup_logging()
 logger = logging.getLogger(__name__)
 
 # 智能加載環境變數
@@ -113,8 +317,10 @@ def load_config():
     config = {
         "BOT_TOKEN": None,
         "GEMINI_API_KEY": None,
+        "GEMINI_API_KEYS": None,
         "DOMAIN": None,
-        "PORT": 8080
+        "PORT": 8080,
+        "WORKERS": None
     }
     
     # 優先級1: 環境變數
@@ -137,10 +343,10 @@ def load_config():
                                     value = value.strip().strip('"\'')
                                     if key in config:
                                         config[key] = value
-                    logger.info(f"從 {env_file} 加載配置")
+                    logger.info("從 %s 加載配置", env_file)
                     break
                 except Exception as e:
-                    logger.warning(f"讀取 {env_file} 失敗: {e}")
+                    logger.warning("讀取 %s 失敗: %s", env_file, e)
     
     # 優先級3: 命令行參數
     import argparse
@@ -149,12 +355,14 @@ def load_config():
     parser.add_argument('--key', help='Gemini API Key')
     parser.add_argument('--domain', help='Webhook Domain')
     parser.add_argument('--port', type=int, default=8080, help='Port')
+    parser.add_argument('--workers', help='多進程數（auto 為 CPU 數，默認單進程）')
     args = parser.parse_args()
     
     if args.token: config["BOT_TOKEN"] = args.token
     if args.key: config["GEMINI_API_KEY"] = args.key
     if args.domain: config["DOMAIN"] = args.domain
     if args.port: config["PORT"] = args.port
+    if args.workers: config["WORKERS"] = args.workers
     
     return config
 
@@ -162,8 +370,28 @@ def load_config():
 config = load_config()
 BOT_TOKEN = config["BOT_TOKEN"]
 GEMINI_API_KEY = config["GEMINI_API_KEY"]
+# 多個 API Key（逗號分隔），與 GEMINI_API_KEY 合併去重
+GEMINI_API_KEYS = [key.strip() for key in (config["GEMINI_API_KEYS"] or "").split(",") if key.strip()]
+if GEMINI_API_KEY and GEMINI_API_KEY not in GEMINI_API_KEYS:
+    GEMINI_API_KEYS.insert(0, GEMINI_API_KEY)
+GEMINI_API_KEY = GEMINI_API_KEY or (GEMINI_API_KEYS[0] if GEMINI_API_KEYS else None)
 DOMAIN = config["DOMAIN"]
-PORT = config["PORT"]
+PORT = int(config["PORT"])
+
+# 多進程（SO_REUSEPORT）：auto 為可用 CPU 數，0/未設置為單進程
+if str(config["WORKERS"] or "").lower() == "auto":
+    WORKERS = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+else:
+    WORKERS = int(config["WORKERS"] or 0)
+
+# 分片部署：standalone（默認）/ frontdoor（只接收並轉發 webhook）/ worker（處理分配到的群組）
+BOT_ROLE = os.getenv("BOT_ROLE", "standalone").lower()
+SHARD_NODES = [node.strip().rstrip("/") for node in os.getenv("SHARD_NODES", "").split(",") if node.strip()]
+SHARD_SECRET = os.getenv("SHARD_SECRET")
+
+# 可選：自定義 API 地址（本地模擬服務器/壓測用）
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+GEMINI_API_ENDPOINT = os.getenv("GEMINI_API_ENDPOINT")
 
 # 檢查必要配置
 if not BOT_TOKEN:
@@ -175,27 +403,40 @@ if not BOT_TOKEN:
     sys.exit(1)
 
 if not GEMINI_API_KEY:
-    logger.error("❌ GEMINI_API_KEY 未設置")
+    logger.error("❌ GEMINI_API_KEY 未設置（或使用 GEMINI_API_KEYS 設置多個）")
     logger.info("獲取地址: https://makersuite.google.com/app/apikey")
     sys.exit(1)
 
 # ========== 初始化 ==========
-MODEL_POOL = [
-    "gemini-1.5-flash",
-    "models/gemini-1.5-flash",
-    "gemini-1.5-pro"
-]
-
 MAX_CONTEXT = 6
 MAX_RETRIES = 3
+WORKER_THREADS = int(os.getenv("BOT_WORKER_THREADS", 16))
+
+# 請求優先級（數字越小越優先）
+PRIORITY_COMMAND = 0  # 命令 / @機器人
+PRIORITY_REPLY = 1    # 回覆機器人
+PRIORITY_KEYWORD = 2  # 關鍵詞觸發
+
+# 本地限速（每個 Key 每分鐘），0 表示不限制
+try:
+    GEMINI_RPM = int(os.getenv("GEMINI_RPM", 0))
+    GEMINI_TPM = int(os.getenv("GEMINI_TPM", 0))
+    if GEMINI_RPM < 0 or GEMINI_TPM < 0:
+        raise ValueError("不能為負數")
+except ValueError as e:
+    logger.error("❌ GEMINI_RPM / GEMINI_TPM 配置錯誤: %s", e)
+    sys.exit(1)
 
-# 初始化AI
+# 初始化客戶端（Gemini 客戶端由 ApiKeyPool 按 Key 創建）
 try:
-    genai.configure(api_key=GEMINI_API_KEY)
-    bot = telebot.TeleBot(BOT_TOKEN, parse_mode=None)
+    if TELEGRAM_API_URL:
+        telebot.apihelper.API_URL = TELEGRAM_API_URL.rstrip("/") + "/bot{0}/{1}"
+        telebot.apihelper.FILE_URL = TELEGRAM_API_URL.rstrip("/") + "/file/bot{0}/{1}"
+    # 更新由 UpdateDispatcher 分發到線程池，便於統計和排空處理中的請求
+    bot = telebot.TeleBot(BOT_TOKEN, parse_mode=None, threaded=False)
     app = Flask(__name__)
 except Exception as e:
-    logger.error(f"初始化失敗: {e}")
+    logger.error("初始化失敗: %s", e)
     sys.exit(1)
 
 context_cache = {}
@@ -232,11 +473,15 @@ class NetworkUtils:
         return None
     
     @staticmethod
-    def check_port(port):
-        """檢查端口是否可用"""
+    def check_port(port, reuse_port=False):
+        """檢查端口是否可用（reuse_port 時允許與其他 SO_REUSEPORT 監聽者共用）"""
         import socket
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
+            # 與 werkzeug 一致設置 SO_REUSEADDR，重啟後 TIME_WAIT 連接不算佔用
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if reuse_port:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             sock.bind(("0.0.0.0", port))
             return True
         except:
@@ -357,69 +602,494 @@ class MathCalculator:
         except Exception as e:
             raise ValueError(f"計算錯誤: {str(e)}")
 
-# ========== AI 服務 ==========
-class AIService:
-    def __init__(self, api_key):
-        self.api_key = api_key
-        self.models = MODEL_POOL
-        self.current_model_index = 0
-        
-    def get_response(self, prompt, chat_id=None):
-        """獲取AI回應"""
-        for attempt in range(MAX_RETRIES):
-            try:
-                model_name = self.models[self.current_model_index]
-                model = genai.GenerativeModel(model_name)
-                
-                # 優化提示詞
-                optimized_prompt = f"""請用中文回答以下問題。注意：
+# ========== 提示詞預算 ==========
+PROMPT_TEMPLATE = """請用中文回答以下問題。注意：
 1. 保持回答簡潔明了
 2. 使用自然的對話語氣
 3. 如果需要強調，可以使用*強調*或_斜體_
 4. 代碼請使用```包裹
 5. 避免使用複雜的Markdown
-
+{history}
 問題：{prompt}
 
 請回答："""
+
+class PromptBudget:
+    """按 token 預算組裝提示詞，並壓縮較舊的對話上下文"""
+    def __init__(self, chat_budget=3000, exact_count=False):
+        self.chat_budget = chat_budget    # 每個聊天的輸入 token 預算
+        self.exact_count = exact_count    # 接近預算時使用 count_tokens 精確計數
+        self.template_tokens = self.estimate_tokens(PROMPT_TEMPLATE)
+        self.lock = threading.Lock()
+    
+    @staticmethod
+    def estimate_tokens(text):
+        """本地估算 token 數：中日韓字符約1個token，其他約4個字符1個token"""
+        if not text:
+            return 0
+        cjk = sum(1 for c in text if '\u2e80' <= c <= '\u9fff' or '\uac00' <= c <= '\ud7af' or '\uff00' <= c <= '\uffef')
+        return cjk + (len(text) - cjk + 3) // 4
+    
+    def count_tokens(self, text, model=None, force=False):
+        """計算 token 數，只在接近預算（或 force）時才調用 count_tokens（需要網絡往返）"""
+        estimate = self.estimate_tokens(text)
+        if not self.exact_count or model is None or (estimate < self.chat_budget * 0.8 and not force):
+            return estimate
+        try:
+            return model.count_tokens(text).total_tokens
+        except Exception as e:
+            logger.debug("count_tokens 失敗，使用估算值: %s", e)
+            return estimate
+    
+    @staticmethod
+    def compact_turn(text, limit=80):
+        """壓縮較舊的對話：保留開頭和結尾"""
+        text = ' '.join(text.split())
+        if len(text) <= limit:
+            return text
+        half = limit // 2
+        return f"{text[:half]}…{text[-half:]}"
+    
+    def build_prompt(self, prompt, chat_id=None, model=None):
+        """在預算內組裝提示詞，返回 (提示詞, token數)"""
+        with self.lock:
+            turns = list(context_cache.get(chat_id, ())) if chat_id is not None else []
+        
+        budget = self.chat_budget
+        for _ in range(3):
+            text = self._assemble(prompt, turns, budget)
+            # 已發現估算偏低時，重新組裝後繼續精確計數
+            tokens = self.count_tokens(text, model, force=budget < self.chat_budget)
+            if tokens <= self.chat_budget:
+                break
+            # 精確計數超出預算（本地估算偏低）：按超出量收緊估算預算後重新組裝
+            budget = max(budget - (tokens - self.chat_budget), self.template_tokens + 1)
+        return text, tokens
+    
+    def _assemble(self, prompt, turns, budget):
+        """按估算 token 在 budget 內組裝提示詞"""
+        prompt_tokens = self.estimate_tokens(prompt)
+        remaining = budget - self.template_tokens - prompt_tokens
+        
+        # 問題本身超出預算時截斷
+        if remaining < 0:
+            keep = max(len(prompt) * (budget - self.template_tokens) // max(prompt_tokens, 1), 1)
+            prompt = prompt[:keep] + "...[截斷]"
+            remaining = 0
+        
+        # 從最新往舊選取，最近兩條保留原文，更舊的壓縮
+        lines = []
+        for index, (role, text) in enumerate(reversed(turns)):
+            speaker = "用戶" if role == "user" else "助手"
+            line = f"{speaker}：{text if index < 2 else self.compact_turn(text)}"
+            cost = self.estimate_tokens(line)
+            if cost > remaining:
+                line = f"{speaker}：{self.compact_turn(text)}"
+                cost = self.estimate_tokens(line)
+                if cost > remaining:
+                    break
+            lines.append(line)
+            remaining -= cost
+        
+        history = ""
+        if lines:
+            history = "\n對話記錄：\n" + "\n".join(reversed(lines)) + "\n"
+        
+        return PROMPT_TEMPLATE.format(history=history, prompt=prompt)
+    
+    def remember(self, chat_id, prompt, answer):
+        """記錄對話上下文（最多 MAX_CONTEXT 條）"""
+        if chat_id is None:
+            return
+        with self.lock:
+            turns = context_cache.setdefault(chat_id, deque(maxlen=MAX_CONTEXT))
+            turns.append(("user", prompt))
+            turns.append(("model", answer))
+
+# ========== 生成配置 ==========
+class GenerationProfile:
+    """一類請求使用的模型和生成參數，並統計延遲和 token 消耗"""
+    def __init__(self, name, models, max_output_tokens, temperature=0.7, top_p=0.9, top_k=40):
+        self.name = name
+        self.models = list(models)  # 按優先順序，遇到配額錯誤時依次降級
+        self.max_output_tokens = max_output_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.top_k = top_k
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=500)  # 最近的成功請求延遲（秒）
+        self.stats = {"requests": 0, "failures": 0, "prompt_tokens": 0, "output_tokens": 0, "by_model": {}}
+    
+    def generation_config(self, max_output_tokens=None):
+        return {
+            "temperature": self.temperature,
+            "top_p": self.top_p,
+            "top_k": self.top_k,
+            "max_output_tokens": max_output_tokens or self.max_output_tokens,
+        }
+    
+    def record(self, model_name, latency, prompt_tokens, output_tokens):
+        with self.lock:
+            self.latencies.append(latency)
+            self.stats["requests"] += 1
+            self.stats["prompt_tokens"] += prompt_tokens
+            self.stats["output_tokens"] += output_tokens
+            self.stats["by_model"][model_name] = self.stats["by_model"].get(model_name, 0) + 1
+    
+    def record_failure(self):
+        with self.lock:
+            self.stats["failures"] += 1
+    
+    def metrics(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            requests = self.stats["requests"]
+            tokens = self.stats["prompt_tokens"] + self.stats["output_tokens"]
+            return {
+                "models": self.models,
+                "max_output_tokens": self.max_output_tokens,
+                "requests": requests,
+                "failures": self.stats["failures"],
+                "latency_p50_ms": round(latencies[len(latencies) // 2] * 1000) if latencies else None,
+                "latency_p95_ms": round(latencies[int(len(latencies) * 0.95)] * 1000) if latencies else None,
+                "prompt_tokens": self.stats["prompt_tokens"],
+                "output_tokens": self.stats["output_tokens"],
+                "tokens_per_request": round(tokens / requests) if requests else None,
+                "by_model": dict(self.stats["by_model"])
+            }
+
+def marker_pattern(markers):
+    """英文標記按單詞邊界匹配（避免 'hi' 匹配 'this'），中文和符號按子串匹配"""
+    parts = [r'\b' + re.escape(marker.strip()) + r'\b' if re.fullmatch(r'[a-z ]+', marker) else re.escape(marker)
+             for marker in markers]
+    return re.compile('|'.join(parts), re.IGNORECASE)
+
+class ProfileRouter:
+    """接收請求時按長度、觸發方式和代碼/數學標記低成本分類，選擇生成配置"""
+    # 需要較長回答的標記
+    HEAVY_MARKERS = ['```', 'def ', 'class ', 'import ', '代碼', '程式', '詳細', '步驟', '解釋', '為什麼',
+                     '比較', '分析', 'code', 'explain', 'why', 'how to', 'step']
+    HEAVY_PATTERN = marker_pattern(HEAVY_MARKERS)
+    # 閒聊/短句標記（只對短句生效，寒暄開頭的長問題仍按普通問題處理）
+    CHAT_MARKERS = ['你好', '哈囉', '早安', '晚安', '謝謝', '感謝', 'hi', 'hello', 'thanks']
+    CHAT_PATTERN = marker_pattern(CHAT_MARKERS)
+    CHAT_MARKER_MAX_TOKENS = 30
+    # 數學題（純算式已由計算器處理，這裡是需要推導的問題）
+    MATH_PATTERN = re.compile(r'\d\s*[+*/^=]\s*\d|[∫∑√π]|方程|積分|微分|證明|求解|機率|概率|矩陣')
+    DEFAULTS = {
+        "chat": {"models": ["gemini-1.5-flash"], "max_output_tokens": 256, "temperature": 0.8},
+        "standard": {"models": ["gemini-1.5-flash", "gemini-1.5-pro"], "max_output_tokens": 800},
+        "heavy": {"models": ["gemini-1.5-pro", "gemini-1.5-flash"], "max_output_tokens": 2000, "temperature": 0.4},
+        "summary": {"models": ["gemini-1.5-flash", "gemini-1.5-pro"], "max_output_tokens": 800, "temperature": 0.3},
+    }
+    
+    # 可覆蓋的字段及其類型
+    FIELDS = {"models": list, "max_output_tokens": int, "temperature": (int, float), "top_p": (int, float),
+              "top_k": int}
+    
+    def __init__(self, overrides=None):
+        overrides = overrides or {}
+        self.profiles = {name: GenerationProfile(name, **dict(options, **overrides.get(name, {})))
+                         for name, options in self.DEFAULTS.items()}
+    
+    @classmethod
+    def parse_overrides(cls, raw):
+        """解析並檢查 GENERATION_PROFILES，格式錯誤時拋出 ValueError"""
+        if not raw:
+            return {}
+        try:
+            overrides = json.loads(raw)
+        except ValueError as e:
+            raise ValueError(f"不是有效的 JSON: {e}")
+        if not isinstance(overrides, dict):
+            raise ValueError("應為 JSON 對象，例如 {\"heavy\": {\"max_output_tokens\": 1500}}")
+        for name, options in overrides.items():
+            if name not in cls.DEFAULTS:
+                raise ValueError(f"未知配置 {name!r}，可用: {', '.join(cls.DEFAULTS)}")
+            if not isinstance(options, dict):
+                raise ValueError(f"配置 {name!r} 應為 JSON 對象")
+            for field, value in options.items():
+                if field not in cls.FIELDS:
+                    raise ValueError(f"配置 {name!r} 的未知字段 {field!r}，可用: {', '.join(cls.FIELDS)}")
+                if isinstance(value, bool) or not isinstance(value, cls.FIELDS[field]):
+                    raise ValueError(f"配置 {name!r} 的字段 {field!r} 類型錯誤: {value!r}")
+            models = options.get("models")
+            if models is not None and (not models or not all(isinstance(m, str) and m for m in models)):
+                raise ValueError(f"配置 {name!r} 的 models 應為非空的模型名稱列表")
+            if options.get("max_output_tokens", 1) <= 0:
+                raise ValueError(f"配置 {name!r} 的 max_output_tokens 應大於 0")
+        return overrides
+    
+    @property
+    def models(self):
+        """所有配置用到的模型（去重，保持順序）"""
+        return list(dict.fromkeys(name for profile in self.profiles.values() for name in profile.models))
+    
+    def get(self, name):
+        return self.profiles[name]
+    
+    def classify(self, prompt, priority=None, media=None):
+        """返回生成配置名稱"""
+        tokens = PromptBudget.estimate_tokens(prompt)
+        if tokens > 300 or self.HEAVY_PATTERN.search(prompt) or self.MATH_PATTERN.search(prompt):
+            return "heavy"
+        if media:
+            return "standard"
+        # 短句、寒暄，以及關鍵詞順帶觸發的普通聊天
+        if (tokens <= 20 or (tokens <= self.CHAT_MARKER_MAX_TOKENS and self.CHAT_PATTERN.search(prompt))
+                or (priority == PRIORITY_KEYWORD and tokens <= 60)):
+            return "chat"
+        return "standard"
+    
+    def metrics(self):
+        return {name: profile.metrics() for name, profile in self.profiles.items()}
+
+# ========== API Key 配額池 ==========
+class ApiKeySlot:
+    """單個 API Key：獨立客戶端 + 每分鐘請求/token 計數 + 按模型冷卻"""
+    def __init__(self, key, rpm, tpm, client):
+        self.key = key
+        self.rpm = rpm
+        self.tpm = tpm
+        self.client = client
+        self.window = deque()  # [時間, token數]
+        self.tokens = 0
+        self.cooldowns = {}  # 模型 -> [冷卻結束時間, 連續配額錯誤次數]（Gemini 配額按 Key + 模型計算）
+        self.total_requests = 0
+        self.total_quota_errors = 0
+    
+    @property
+    def name(self):
+        return f"...{self.key[-4:]}"
+    
+    def trim(self, now):
+        while self.window and now - self.window[0][0] >= 60:
+            self.tokens -= self.window.popleft()[1]
+    
+    def headroom(self, now):
+        """剩餘額度比例（0~1）；rpm/tpm 為 0 時不限制"""
+        self.trim(now)
+        ratios = [1.0]
+        if self.rpm:
+            ratios.append(1 - len(self.window) / self.rpm)
+        if self.tpm:
+            ratios.append(1 - self.tokens / self.tpm)
+        return min(ratios)
+    
+    def cooling(self, model, now):
+        return now < self.cooldowns.get(model, (0, 0))[0]
+
+class ApiKeyPool:
+    """多 API Key 配額池：選擇剩餘額度最多的 Key；默認不在本地限速，只在收到配額錯誤後冷卻"""
+    def __init__(self, keys, rpm=0, tpm=0, endpoint=None):
+        self.lock = threading.Lock()
+        self.slots = [ApiKeySlot(key, rpm, tpm, self.create_client(key, endpoint)) for key in keys]
+    
+    @staticmethod
+    def create_client(key, endpoint=None):
+        """為每個 Key 創建獨立的 GenerativeService 客戶端"""
+        client_options = {"api_key": key}
+        if endpoint:
+            client_options["api_endpoint"] = endpoint
+            return glm.GenerativeServiceClient(client_options=client_options, transport="rest")
+        return glm.GenerativeServiceClient(client_options=client_options)
+    
+    def acquire(self, tokens, models):
+        """按 models 的優先順序選出可用的 (Key, 模型)，同一模型選額度最多的 Key，並預扣 tokens；
+        全部用盡時返回 (None, None, None)"""
+        now = time.time()
+        with self.lock:
+            for model in models:
+                candidates = [slot for slot in self.slots if not slot.cooling(model, now) and slot.headroom(now) > 0]
+                if not candidates:
+                    continue
+                # 額度相同（如不限速）時選最近一分鐘請求最少的 Key
+                best = max(candidates, key=lambda slot: (slot.headroom(now), -len(slot.window)))
+                entry = [now, tokens]
+                best.window.append(entry)
+                best.tokens += tokens
+                best.total_requests += 1
+                return best, entry, model
+            return None, None, None
+    
+    def settle(self, slot, entry, tokens, model):
+        """用實際用量修正預扣的 tokens"""
+        with self.lock:
+            slot.trim(time.time())
+            if slot.window and entry in slot.window:
+                slot.tokens += tokens - entry[1]
+                entry[1] = tokens
+            slot.cooldowns.pop(model, None)
+    
+    def report_quota_error(self, slot, model):
+        """配額錯誤：指數退避冷卻該 Key 上的這個模型，其他模型不受影響"""
+        with self.lock:
+            failures = slot.cooldowns.get(model, (0, 0))[1] + 1
+            slot.total_quota_errors += 1
+            slot.cooldowns[model] = [time.time() + min(60, 5 * 2 ** (failures - 1)), failures]
+    
+    def available(self, models=None):
+        """有額度的 Key 數量；指定 models 時只計算至少有一個模型未冷卻的 Key"""
+        now = time.time()
+        with self.lock:
+            return sum(1 for slot in self.slots if slot.headroom(now) > 0 and
+                       (models is None or any(not slot.cooling(model, now) for model in models)))
+    
+    def model_available(self, model):
+        """是否有 Key 可以調用該模型（未冷卻）"""
+        now = time.time()
+        with self.lock:
+            return any(not slot.cooling(model, now) for slot in self.slots)
+    
+    def stats(self):
+        now = time.time()
+        with self.lock:
+            result = []
+            for slot in self.slots:
+                slot.trim(now)
+                result.append({
+                    "key": slot.name,
+                    "rpm_used": len(slot.window),
+                    "tpm_used": slot.tokens,
+                    "cooldown": {model: round(until - now, 1) for model, (until, _) in slot.cooldowns.items()
+                                 if until > now},
+                    "requests": slot.total_requests,
+                    "quota_errors": slot.total_quota_errors
+                })
+            return result
+
+class ModelClient:
+    """用某個 Key 的 GenerativeServiceClient 調用指定模型（glm 公開接口）"""
+    def __init__(self, client, model_name):
+        self.client = client
+        self.model = model_name if model_name.startswith("models/") else f"models/{model_name}"
+    
+    @staticmethod
+    def to_content(contents):
+        """文本或 [inline 數據, 文本] 轉為 glm.Content"""
+        parts = []
+        for part in contents if isinstance(contents, list) else [contents]:
+            if isinstance(part, dict):
+                parts.append(glm.Part(inline_data=glm.Blob(mime_type=part["mime_type"], data=part["data"])))
+            else:
+                parts.append(glm.Part(text=part))
+        return glm.Content(role="user", parts=parts)
+    
+    def count_tokens(self, contents):
+        return self.client.count_tokens(glm.CountTokensRequest(model=self.model, contents=[self.to_content(contents)]))
+    
+    def generate_content(self, contents, generation_config):
+        return self.client.generate_content(glm.GenerateContentRequest(
+            model=self.model,
+            contents=[self.to_content(contents)],
+            generation_config=glm.GenerationConfig(**generation_config)
+        ))
+    
+    @staticmethod
+    def response_text(response):
+        """取第一個候選的文本，被安全過濾等原因沒有內容時拋出 ValueError"""
+        if not response.candidates or not response.candidates[0].content.parts:
+            raise ValueError(f"模型沒有返回內容: {response.prompt_feedback}")
+        return "".join(part.text for part in response.candidates[0].content.parts)
+
+# ========== AI 服務 ==========
+class AIService:
+    def __init__(self, key_pool, budget=None, profiles=None):
+        self.keys = key_pool
+        self.profiles = profiles or ProfileRouter()
+        self.models = self.profiles.models
+        self.budget = budget or PromptBudget()
+        self.quota_errors = {}  # 模型 -> 最近一次配額錯誤時間
+    
+    def is_saturated(self):
+        """沒有任何 (Key, 模型) 組合可用"""
+        return not self.keys.available(self.models)
+        
+    FAILURE_REPLY = "抱歉，AI服務暫時不可用，請稍後再試。"
+    
+    def get_response(self, prompt, chat_id=None, media=None, profile=None):
+        """獲取AI回應（media 為 MediaService 返回的 inline 數據，profile 為生成配置名稱）"""
+        profile = self.profiles.get(profile or self.profiles.classify(prompt, media=media))
+        max_output_tokens = profile.max_output_tokens
+        reserve = self.budget.estimate_tokens(prompt) + self.budget.template_tokens + max_output_tokens
+        if media:
+            reserve += MediaService.estimate_tokens(media)
+        
+        def build(model):
+            # 按預算組裝提示詞（含壓縮後的上下文）
+            optimized_prompt, prompt_tokens = self.budget.build_prompt(prompt, chat_id, model)
+            logger.debug("提示詞 %d tokens，配置 %s", prompt_tokens, profile.name)
+            return [media, optimized_prompt] if media else optimized_prompt
+        
+        text = self._generate(build, reserve, profile)
+        if text is None:
+            return self.FAILURE_REPLY
+        
+        # 記錄上下文（不保存圖片數據，只留標記）
+        self.budget.remember(chat_id, f"[{MediaService.label(media)}] {prompt}" if media else prompt, text)
+        return text
+    
+    def generate(self, prompt, max_output_tokens=800, profile="summary"):
+        """直接生成（不套用問答模板、不記錄上下文），失敗返回 None"""
+        reserve = self.budget.estimate_tokens(prompt) + max_output_tokens
+        return self._generate(lambda model: prompt, reserve, self.profiles.get(profile), max_output_tokens)
+    
+    def select_model(self, profile):
+        """按配置順序選擇還有 Key 未冷卻的模型，都在冷卻時選最早出錯的"""
+        for name in profile.models:
+            if self.keys.model_available(name):
+                return name
+        return min(profile.models, key=lambda name: self.quota_errors.get(name, 0))
+    
+    def _generate(self, make_prompt, reserve, profile, max_output_tokens=None):
+        """選擇 Key 和模型並重試，失敗返回 None"""
+        for attempt in range(MAX_RETRIES):
+            # 按配置順序選擇模型，再選剩餘額度最多的 Key（按預估用量預扣）
+            slot, entry, model_name = self.keys.acquire(reserve, profile.models)
+            if slot is None:
+                logger.warning("所有API Key額度已用盡，等待冷卻")
+                time.sleep(1)
+                continue
+            
+            started = time.time()
+            try:
+                model = ModelClient(slot.client, model_name)
+                response = model.generate_content(make_prompt(model), profile.generation_config(max_output_tokens))
+                text = ModelClient.response_text(response).strip()
                 
-                response = model.generate_content(
-                    optimized_prompt,
-                    generation_config={
-                        "temperature": 0.7,
-                        "top_p": 0.9,
-                        "top_k": 40,
-                        "max_output_tokens": 2000,
-                    }
+                # 按實際用量修正 Key 的 token 計數
+                usage = getattr(response, "usage_metadata", None)
+                self.keys.settle(slot, entry, getattr(usage, "total_token_count", 0) or reserve, model_name)
+                profile.record(
+                    model_name, time.time() - started,
+                    getattr(usage, "prompt_token_count", 0) or reserve - (max_output_tokens or profile.max_output_tokens),
+                    getattr(usage, "candidates_token_count", 0) or self.budget.estimate_tokens(text)
                 )
                 
-                text = response.text.strip()
-                
                 # 清理回應
-                text = self.clean_response(text)
-                
-                # 切換到下一個模型（循環）
-                self.current_model_index = (self.current_model_index + 1) % len(self.models)
-                
-                return text
+                return self.clean_response(text)
                 
             except Exception as e:
                 error_msg = str(e).lower()
                 
                 if "quota" in error_msg or "429" in error_msg:
-                    logger.warning(f"模型配額不足，嘗試下一個模型")
-                    self.current_model_index = (self.current_model_index + 1) % len(self.models)
-                    time.sleep(1)
+                    # 只冷卻該 Key 上的這個模型，下次選擇其他 Key 或降級到下一個模型
+                    self.keys.report_quota_error(slot, model_name)
+                    self.quota_errors[model_name] = time.time()
+                    logger.warning("Key %s 的 %s 配額不足，嘗試其他Key/模型", slot.name, model_name)
                     continue
                 elif "unavailable" in error_msg or "500" in error_msg:
-                    logger.warning(f"模型暫時不可用")
+                    logger.warning("模型暫時不可用")
                     time.sleep(2)
                     continue
                 else:
-                    logger.error(f"AI錯誤: {e}")
+                    logger.error("AI錯誤: %s", e)
                     
                 if attempt == MAX_RETRIES - 1:
-                    return "抱歉，AI服務暫時不可用，請稍後再試。"
+                    break
+        
+        profile.record_failure()
+        return None
     
     @staticmethod
     def clean_response(text):
@@ -443,67 +1113,899 @@ class AIService:
         
         return text
 
+# ========== 圖片與文件 ==========
+class MediaError(Exception):
+    """圖片/文件無法處理（類型不支持、過大、下載失敗）"""
+
+class MediaService:
+    """下載消息中的圖片/文件並轉為 Gemini inline 數據，按 file_unique_id 緩存"""
+    IMAGE_TYPES = {"image/jpeg", "image/png", "image/webp", "image/heic", "image/heif"}
+    DOCUMENT_TYPES = IMAGE_TYPES | {"application/pdf", "text/plain", "text/csv", "text/markdown", "text/html"}
+    IMAGE_TOKENS = 258  # Gemini 每張圖片固定計費的 token 數
+    DEFAULT_PROMPTS = {"圖片": "請描述這張圖片的內容", "文件": "請總結這個文件的內容"}
+    
+    def __init__(self, bot, target_px=1024, max_bytes=10 * 1024 * 1024, cache_bytes=64 * 1024 * 1024, workers=2):
+        self.bot = bot
+        self.target_px = target_px      # 圖片長邊目標像素
+        self.max_bytes = max_bytes      # 單個文件下載上限，0 表示關閉
+        self.cache_bytes = cache_bytes  # 處理後數據的緩存上限
+        self.cache = OrderedDict()      # file_unique_id -> inline 數據
+        self.cache_size = 0
+        self.inflight = {}              # file_unique_id -> Future，同一文件並發請求只下載一次
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="media")
+        self.stats = {"hits": 0, "downloads": 0, "downloaded_bytes": 0, "resized": 0, "rejected": 0}
+    
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+    
+    @staticmethod
+    def has_media(msg):
+        return bool(getattr(msg, "photo", None)) or getattr(msg, "document", None) is not None
+    
+    @staticmethod
+    def label(part):
+        return "圖片" if part["mime_type"].startswith("image/") else "文件"
+    
+    @classmethod
+    def estimate_tokens(cls, part):
+        """估算 inline 數據的 token 數（圖片固定，文本按大小，PDF 粗略按每頁 3KB 計）"""
+        if part["mime_type"].startswith("image/"):
+            return cls.IMAGE_TOKENS
+        if part["mime_type"].startswith("text/"):
+            return len(part["data"]) // 4
+        return len(part["data"]) // 3000 * cls.IMAGE_TOKENS + cls.IMAGE_TOKENS
+    
+    def pick_photo(self, sizes):
+        """選擇長邊不小於目標尺寸的最小版本，都不夠大時用最大的"""
+        sizes = sorted(sizes, key=lambda size: size.width * size.height)
+        for size in sizes:
+            if max(size.width, size.height) >= self.target_px:
+                return size
+        return sizes[-1]
+    
+    def describe(self, msg):
+        """返回 (file_id, file_unique_id, mime_type, file_size)"""
+        if msg.photo:
+            size = self.pick_photo(msg.photo)
+            return size.file_id, size.file_unique_id, "image/jpeg", size.file_size
+        document = msg.document
+        mime_type = (document.mime_type or "").lower()
+        if mime_type not in self.DOCUMENT_TYPES:
+            raise MediaError("不支持的文件類型，僅支持圖片、PDF 和文本文件")
+        return document.file_id, document.file_unique_id, mime_type, document.file_size
+    
+    def get(self, msg):
+        """獲取消息中圖片/文件的 inline 數據，失敗拋出 MediaError"""
+        file_id, unique_id, mime_type, file_size = self.describe(msg)
+        if file_size and file_size > self.max_bytes:
+            self.count("rejected")
+            raise MediaError(f"文件過大（上限 {self.max_bytes // (1024 * 1024)}MB）")
+        
+        with self.lock:
+            part = self.cache.get(unique_id)
+            if part is not None:
+                self.cache.move_to_end(unique_id)
+                self.stats["hits"] += 1
+                return part
+            future = self.inflight.get(unique_id)
+            owner = future is None
+            if owner:
+                future = self.inflight[unique_id] = Future()
+        
+        # 其他線程正在下載同一個文件
+        if not owner:
+            self.count("hits")
+            return future.result()
+        
+        try:
+            data = self.download(file_id)
+            # 解碼/縮放是 CPU 密集操作，放到獨立線程池以限制並發
+            part = self.executor.submit(self.process, data, mime_type).result()
+            self.store(unique_id, part)
+            future.set_result(part)
+            return part
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                self.inflight.pop(unique_id, None)
+    
+    def download(self, file_id):
+        """流式下載，超過上限立即中止"""
+        file_info = self.bot.get_file(file_id)
+        if file_info.file_size and file_info.file_size > self.max_bytes:
+            self.count("rejected")
+            raise MediaError(f"文件過大（上限 {self.max_bytes // (1024 * 1024)}MB）")
+        
+        url = (telebot.apihelper.FILE_URL or "https://api.telegram.org/file/bot{0}/{1}").format(
+            self.bot.token, file_info.file_path)
+        data = bytearray()
+        try:
+            with requests.get(url, stream=True, timeout=(5, 30), proxies=telebot.apihelper.proxy) as response:
+                response.raise_for_status()
+                if int(response.headers.get("Content-Length") or 0) > self.max_bytes:
+                    raise MediaError(f"文件過大（上限 {self.max_bytes // (1024 * 1024)}MB）")
+                for chunk in response.iter_content(64 * 1024):
+                    data.extend(chunk)
+                    if len(data) > self.max_bytes:
+                        raise MediaError(f"文件過大（上限 {self.max_bytes // (1024 * 1024)}MB）")
+        except MediaError:
+            self.count("rejected")
+            raise
+        except requests.RequestException as e:
+            raise MediaError(f"下載文件失敗: {e}")
+        
+        self.count("downloads")
+        self.count("downloaded_bytes", len(data))
+        return bytes(data)
+    
+    def process(self, data, mime_type):
+        """超過目標尺寸的圖片縮小並轉為 JPEG，其他數據原樣返回"""
+        if Image is None or mime_type not in self.IMAGE_TYPES:
+            return {"mime_type": mime_type, "data": data}
+        try:
+            with Image.open(io.BytesIO(data)) as image:
+                if max(image.size) <= self.target_px:
+                    return {"mime_type": mime_type, "data": data}
+                image.thumbnail((self.target_px, self.target_px))
+                if image.mode not in ("RGB", "L"):
+                    image = image.convert("RGB")
+                output = io.BytesIO()
+                image.save(output, "JPEG", quality=85)
+        except Exception as e:
+            logger.warning("縮放圖片失敗，使用原圖: %s", e)
+            return {"mime_type": mime_type, "data": data}
+        self.count("resized")
+        return {"mime_type": "image/jpeg", "data": output.getvalue()}
+    
+    def count(self, name, amount=1):
+        """更新統計（多個線程同時下載/縮放）"""
+        with self.lock:
+            self.stats[name] += amount
+    
+    def store(self, unique_id, part):
+        size = len(part["data"])
+        if size > self.cache_bytes:
+            return
+        with self.lock:
+            previous = self.cache.pop(unique_id, None)
+            if previous is not None:
+                self.cache_size -= len(previous["data"])
+            self.cache[unique_id] = part
+            self.cache_size += size
+            while self.cache_size > self.cache_bytes:
+                _, evicted = self.cache.popitem(last=False)
+                self.cache_size -= len(evicted["data"])
+    
+    def metrics(self):
+        with self.lock:
+            return dict(self.stats, cached=len(self.cache), cached_bytes=self.cache_size, inflight=len(self.inflight))
+
+# ========== 准入控制 ==========
+class AdmissionController:
+    """按優先級分配 Gemini 並發名額，飽和時丟棄低優先級請求"""
+    CLASS_NAMES = {
+        PRIORITY_COMMAND: "command",
+        PRIORITY_REPLY: "reply",
+        PRIORITY_KEYWORD: "keyword"
+    }
+    # 各優先級可使用的並發比例，低優先級只能使用部分名額
+    SHARE = {
+        PRIORITY_COMMAND: 1.0,
+        PRIORITY_REPLY: 0.75,
+        PRIORITY_KEYWORD: 0.5
+    }
+    
+    def __init__(self, capacity=4, max_queue=32, queue_timeout=15):
+        self.capacity = capacity
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.cond = threading.Condition()
+        self.inflight = 0
+        self.waiting = []  # 等待中的 (優先級, 序號)
+        self.seq = 0
+        self.stats = {
+            priority: {"admitted": 0, "shed": 0, "inflight": 0, "waiting": 0, "wait_ms_total": 0.0}
+            for priority in self.CLASS_NAMES
+        }
+    
+    def _limit(self, priority):
+        return max(1, int(self.capacity * self.SHARE[priority]))
+    
+    def _can_run(self, priority, ticket):
+        # 只有隊首（最高優先級、最早到達）才能佔用名額
+        return self.inflight < self._limit(priority) and (not self.waiting or self.waiting[0] == ticket)
+    
+    def _shed(self, priority):
+        self.stats[priority]["shed"] += 1
+        return False
+    
+    def acquire(self, priority, saturated=False):
+        """申請名額，返回 False 表示請求被丟棄"""
+        start = time.time()
+        with self.cond:
+            # 上游飽和時只保留命令請求
+            if saturated and priority != PRIORITY_COMMAND:
+                return self._shed(priority)
+            
+            self.seq += 1
+            ticket = (priority, self.seq)
+            if not self._can_run(priority, ticket):
+                # 關鍵詞觸發不排隊
+                if priority == PRIORITY_KEYWORD or len(self.waiting) >= self.max_queue:
+                    return self._shed(priority)
+                
+                heapq.heappush(self.waiting, ticket)
+                self.stats[priority]["waiting"] += 1
+                try:
+                    admitted = self.cond.wait_for(lambda: self._can_run(priority, ticket), timeout=self.queue_timeout)
+                finally:
+                    self.waiting.remove(ticket)
+                    heapq.heapify(self.waiting)
+                    self.stats[priority]["waiting"] -= 1
+                    self.cond.notify_all()
+                if not admitted:
+                    return self._shed(priority)
+            
+            self.inflight += 1
+            self.stats[priority]["inflight"] += 1
+            self.stats[priority]["admitted"] += 1
+            self.stats[priority]["wait_ms_total"] += (time.time() - start) * 1000
+            return True
+    
+    def release(self, priority):
+        with self.cond:
+            self.inflight -= 1
+            self.stats[priority]["inflight"] -= 1
+            self.cond.notify_all()
+    
+    def metrics(self):
+        """各優先級的隊列指標"""
+        with self.cond:
+            result = {"capacity": self.capacity, "inflight": self.inflight, "queue_depth": len(self.waiting), "classes": {}}
+            for priority, name in self.CLASS_NAMES.items():
+                stats = dict(self.stats[priority])
+                wait_total = stats.pop("wait_ms_total")
+                stats["avg_wait_ms"] = round(wait_total / stats["admitted"], 1) if stats["admitted"] else 0.0
+                result["classes"][name] = stats
+            return result
+
+# ========== Webhook 快速路徑 ==========
+class BotIdentity:
+    """緩存 get_me() 結果，避免每條消息都請求 Telegram"""
+    def __init__(self, bot):
+        self.bot = bot
+        self.user = None
+        self.lock = threading.Lock()
+    
+    def get(self):
+        if self.user is None:
+            with self.lock:
+                if self.user is None:
+                    self.user = self.bot.get_me()
+        return self.user
+    
+    @property
+    def id(self):
+        return self.get().id
+    
+    @property
+    def username(self):
+        return self.get().username
+
+class UpdateLite:
+    """只提取判斷是否需要處理的字段，不構建完整的 Update 對象"""
+    __slots__ = ("update_id", "chat_id", "chat_type", "user_id", "thread_id", "text", "reply_to_user_id",
+                 "entities", "data")
+    
+    def __init__(self, update_id, chat_id, chat_type, user_id, thread_id, text, reply_to_user_id, entities, data):
+        self.update_id = update_id
+        self.chat_id = chat_id
+        self.chat_type = chat_type
+        self.user_id = user_id
+        self.thread_id = thread_id
+        self.text = text
+        self.reply_to_user_id = reply_to_user_id
+        self.entities = entities
+        self.data = data  # 原始 dict，需要時再交給 Update.de_json
+    
+    @classmethod
+    def parse(cls, raw):
+        """從原始字節解析，非消息更新（編輯、回調等）返回只有 update_id 的記錄"""
+        data = json_loads(raw)
+        message = data.get("message")
+        if not message:
+            return cls(data.get("update_id"), None, None, None, None, None, None, None, data)
+        
+        chat = message.get("chat") or {}
+        sender = message.get("from") or {}
+        reply_to = message.get("reply_to_message") or {}
+        # 圖片/文件的說明文字按文本處理，沒有說明時為空字符串（回覆機器人時仍需處理）
+        text = message.get("text")
+        if text is None:
+            text = message.get("caption")
+            if text is None and ("photo" in message or "document" in message):
+                text = ""
+        return cls(
+            data.get("update_id"),
+            chat.get("id"),
+            chat.get("type"),
+            sender.get("id"),
+            message.get("message_thread_id") if message.get("is_topic_message") else None,
+            text,
+            (reply_to.get("from") or {}).get("id"),
+            message.get("entities") or message.get("caption_entities"),
+            data
+        )
+
+webhook_stats = {"received": 0, "dropped": 0, "processed": 0}
+
+# ========== 分片路由 ==========
+class HashRing:
+    """一致性哈希環（虛擬節點）"""
+    def __init__(self, nodes=(), replicas=100):
+        self.replicas = replicas
+        self.keys = []   # 排序後的哈希值
+        self.owners = {}  # 哈希值 -> 節點
+        self.nodes = set()
+        for node in nodes:
+            self.add(node)
+    
+    @staticmethod
+    def hash(key):
+        return int.from_bytes(hashlib.md5(str(key).encode("utf-8")).digest()[:8], "big")
+    
+    def add(self, node):
+        if node in self.nodes:
+            return
+        self.nodes.add(node)
+        for i in range(self.replicas):
+            value = self.hash(f"{node}#{i}")
+            self.owners[value] = node
+            bisect.insort(self.keys, value)
+    
+    def remove(self, node):
+        if node not in self.nodes:
+            return
+        self.nodes.discard(node)
+        for i in range(self.replicas):
+            value = self.hash(f"{node}#{i}")
+            del self.owners[value]
+            self.keys.pop(bisect.bisect_left(self.keys, value))
+    
+    def get(self, key):
+        if not self.keys:
+            return None
+        index = bisect.bisect(self.keys, self.hash(key)) % len(self.keys)
+        return self.owners[self.keys[index]]
+
+class ShardRouter:
+    """前門模式：按 chat_id 一致性哈希轉發 webhook 到後端節點"""
+    def __init__(self, nodes, secret=None, lanes=4, health_interval=5, max_failures=3):
+        self.members = list(nodes)  # 配置的全部節點
+        self.ring = HashRing(nodes)  # 當前在線節點
+        self.secret = secret
+        self.lanes = lanes
+        self.health_interval = health_interval
+        self.max_failures = max_failures  # 連續轉發失敗多少次後移出哈希環
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+        self.session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=lanes * 4))
+        self.session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=lanes * 4))
+        self.queues = {}
+        self.stats = {}
+        self.threads = []
+    
+    def start(self):
+        for node in self.members:
+            self._ensure_node(node)
+        thread = threading.Thread(target=self._health_loop, name="shard-health", daemon=True)
+        thread.start()
+        self.threads.append(thread)
+    
+    def _ensure_node(self, node):
+        # 每個節點多條轉發通道，同一 chat 固定在同一通道以保持消息順序
+        if node in self.queues:
+            return
+        self.queues[node] = [queue.Queue(maxsize=1000) for _ in range(self.lanes)]
+        self.stats[node] = {"forwarded": 0, "failed": 0, "consecutive_failures": 0, "healthy": True}
+        for lane, lane_queue in enumerate(self.queues[node]):
+            thread = threading.Thread(target=self._forward_loop, args=(node, lane_queue),
+                                      name=f"shard-{lane}-{node}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+    
+    def _headers(self):
+        headers = {"Content-Type": "application/json"}
+        if self.secret:
+            headers["X-Shard-Secret"] = self.secret
+        return headers
+    
+    def route(self, chat_id, raw):
+        """把原始 update 放入目標節點的轉發隊列"""
+        with self.lock:
+            node = self.ring.get(chat_id)
+        if node is None:
+            logger.error("沒有可用的分片節點，丟棄更新")
+            return False
+        lane = HashRing.hash(chat_id) % self.lanes
+        try:
+            self.queues[node][lane].put_nowait((chat_id, raw, 0))
+            return True
+        except queue.Full:
+            self.stats[node]["failed"] += 1
+            logger.warning("分片節點轉發隊列已滿")
+            return False
+    
+    def _post(self, node, raw):
+        """轉發一次，連續失敗 max_failures 次才移出哈希環（其餘交給健康檢查）"""
+        try:
+            response = self.session.post(f"{node}/webhook", data=raw, headers=self._headers(), timeout=10)
+            response.raise_for_status()
+            self.stats[node]["forwarded"] += 1
+            self.stats[node]["consecutive_failures"] = 0
+            return True
+        except Exception as e:
+            self.stats[node]["failed"] += 1
+            self.stats[node]["consecutive_failures"] += 1
+            logger.warning("轉發到分片節點失敗: %s", e)
+            if self.stats[node]["consecutive_failures"] >= self.max_failures:
+                self.leave(node)
+            return False
+    
+    def _forward_loop(self, node, lane_queue):
+        while True:
+            chat_id, raw, attempt = lane_queue.get()
+            if self._post(node, raw) or attempt > 0:
+                continue
+            
+            # 重試一次：節點仍在環中時原地重試（保持同一 chat 的順序），否則轉到新節點
+            with self.lock:
+                target = self.ring.get(chat_id)
+            if target == node:
+                time.sleep(1)
+                if not self._post(node, raw):
+                    logger.error("轉發重試失敗，丟棄更新")
+            elif target:
+                try:
+                    self.queues[target][HashRing.hash(chat_id) % self.lanes].put_nowait((chat_id, raw, 1))
+                except queue.Full:
+                    self.stats[target]["failed"] += 1
+                    logger.error("分片節點轉發隊列已滿，丟棄更新")
+            else:
+                logger.error("沒有可用的分片節點，丟棄更新")
+    
+    def join(self, node):
+        with self.lock:
+            if node not in self.members:
+                self.members.append(node)
+            self._ensure_node(node)
+            if node not in self.ring.nodes:
+                self.ring.add(node)
+                self.stats[node]["healthy"] = True
+                self.stats[node]["consecutive_failures"] = 0
+                logger.info("分片節點加入: %s（共 %d 個）", node, len(self.ring.nodes))
+    
+    def leave(self, node, forget=False):
+        with self.lock:
+            if node in self.ring.nodes:
+                self.ring.remove(node)
+                self.stats[node]["healthy"] = False
+                logger.warning("分片節點離開: %s（剩餘 %d 個）", node, len(self.ring.nodes))
+            if forget and node in self.members:
+                self.members.remove(node)
+    
+    def _health_loop(self):
+        while True:
+            time.sleep(self.health_interval)
+            for node in list(self.members):
+                try:
+                    healthy = self.session.get(f"{node}/health", timeout=2).status_code == 200
+                except requests.RequestException:
+                    healthy = False
+                if healthy:
+                    self.join(node)
+                else:
+                    self.leave(node)
+    
+    def metrics(self):
+        with self.lock:
+            return {
+                "members": list(self.members),
+                "ring": sorted(self.ring.nodes),
+                "nodes": {
+                    node: dict(stats, queued=sum(q.qsize() for q in self.queues[node]))
+                    for node, stats in self.stats.items()
+                }
+            }
+
+# ========== 突發消息合併 ==========
+class BurstCoalescer:
+    """同一用戶/話題在短時間內連續發送的消息合併為一次 AI 請求"""
+    def __init__(self, window=1.5, max_wait=6, max_messages=5):
+        self.window = window              # 每條新消息後再等待的時間（秒）
+        self.max_wait = max_wait          # 一批最長等待時間（秒）
+        self.max_messages = max_messages  # 一批最多合併的消息數
+        self.lock = threading.Lock()
+        self.batches = {}
+        self.recent = {}  # 前門模式：最近觸發過的 key -> 過期時間
+        self.stats = {"batches": 0, "merged": 0}
+        self.flushing = 0  # 正在回覆的批次
+        self.on_flush = None
+    
+    @property
+    def enabled(self):
+        return self.window > 0
+    
+    @staticmethod
+    def key(chat_id, user_id, thread_id=None):
+        return (chat_id, user_id, thread_id)
+    
+    @staticmethod
+    def key_for(msg):
+        thread_id = msg.message_thread_id if getattr(msg, "is_topic_message", False) else None
+        return BurstCoalescer.key(msg.chat.id, msg.from_user.id if msg.from_user else 0, thread_id)
+    
+    def has_pending(self, key):
+        """是否有等待合併的批次（webhook 快速路徑據此保留後續消息）"""
+        return key in self.batches or self.recent.get(key, 0) > time.time()
+    
+    def touch(self, key):
+        """前門模式沒有本地批次，記錄最近觸發的 key 以便轉發後續消息"""
+        self.recent[key] = time.time() + self.max_wait
+        if len(self.recent) > 10000:
+            now = time.time()
+            self.recent = {k: expiry for k, expiry in self.recent.items() if expiry > now}
+    
+    def start(self, msg, text, priority):
+        """開始一個新批次"""
+        key = self.key_for(msg)
+        with self.lock:
+            batch = {"messages": [msg], "texts": [text], "priority": priority,
+                     "started": time.time(), "timer": None}
+            self.batches[key] = batch
+            self._schedule(key, batch)
+    
+    def append(self, msg, text):
+        """加入已有批次，沒有批次時返回 False"""
+        key = self.key_for(msg)
+        with self.lock:
+            batch = self.batches.get(key)
+            if batch is None:
+                return False
+            batch["messages"].append(msg)
+            batch["texts"].append(text)
+            self.stats["merged"] += 1
+            if len(batch["messages"]) < self.max_messages:
+                self._schedule(key, batch)
+                return True
+            # 已滿：立即移出並回覆，之後的消息不會再加入這一批
+            batch["timer"].cancel()
+            self._detach(key)
+        threading.Thread(target=self._deliver, args=(batch,), name="burst-flush", daemon=True).start()
+        return True
+    
+    def _schedule(self, key, batch, delay=None):
+        if batch["timer"]:
+            batch["timer"].cancel()
+        if delay is None:
+            # 每條新消息重新計時，但不超過 max_wait
+            remaining = self.max_wait - (time.time() - batch["started"])
+            delay = max(0, min(self.window, remaining))
+        batch["timer"] = threading.Timer(delay, self._flush, args=(key, batch))
+        batch["timer"].daemon = True
+        batch["timer"].start()
+    
+    def _detach(self, key):
+        """移出批次並計入正在回覆的數量（需持有鎖）"""
+        del self.batches[key]
+        self.stats["batches"] += 1
+        self.flushing += 1
+    
+    def _flush(self, key, batch):
+        with self.lock:
+            if self.batches.get(key) is not batch:
+                return
+            self._detach(key)
+        self._deliver(batch)
+    
+    def _deliver(self, batch):
+        try:
+            self.on_flush(batch["messages"], "\n".join(batch["texts"]), batch["priority"])
+        except Exception as e:
+            logger.error("處理合併消息錯誤: %s", e)
+        finally:
+            with self.lock:
+                self.flushing -= 1
+    
+    def idle(self):
+        with self.lock:
+            return not self.batches and not self.flushing
+    
+    def metrics(self):
+        with self.lock:
+            return dict(self.stats, pending=len(self.batches), flushing=self.flushing)
+
+# ========== 群組歷史與總結 ==========
+class ChatLog:
+    """單個群組的消息記錄：未滿的塊保留原文，滿了壓縮封存"""
+    def __init__(self, epoch):
+        self.epoch = epoch    # 第幾次開啟記錄，關閉再開啟後序號重新開始，緩存 key 不會衝突
+        self.seq = 0          # 消息序號
+        self.lines = []       # 當前塊（原文）
+        self.tokens = 0
+        self.blocks = deque()  # 已封存的塊: (起始序號, 結束序號, 條數, 壓縮數據)
+        self.count = 0         # 已封存塊中的消息數
+
+class GroupHistory:
+    """選擇加入的群組消息記錄（有界、壓縮）"""
+    def __init__(self, max_messages=2000, chunk_tokens=1500, chunk_messages=200, chats=()):
+        self.max_messages = max_messages    # 每個群組最多保留的消息數
+        self.chunk_tokens = chunk_tokens    # 每塊 token 上限（即每次 map 調用的輸入大小）
+        self.chunk_messages = chunk_messages
+        self.enabled_chats = set(chats)
+        self.logs = {}
+        self.epoch = 0  # 已創建的 ChatLog 數
+        self.lock = threading.Lock()
+    
+    @property
+    def available(self):
+        return self.max_messages > 0
+    
+    def is_enabled(self, chat_id):
+        return chat_id in self.enabled_chats
+    
+    def enable(self, chat_id):
+        self.enabled_chats.add(chat_id)
+    
+    def disable(self, chat_id):
+        """關閉記錄並刪除已保存的消息"""
+        self.enabled_chats.discard(chat_id)
+        with self.lock:
+            self.logs.pop(chat_id, None)
+    
+    def record(self, chat_id, name, text, timestamp):
+        if chat_id not in self.enabled_chats or not text:
+            return
+        line = f"{datetime.fromtimestamp(timestamp).strftime('%m-%d %H:%M')} {name}: {' '.join(text.split())}"
+        tokens = PromptBudget.estimate_tokens(line)
+        with self.lock:
+            log = self.logs.get(chat_id)
+            if log is None:
+                self.epoch += 1
+                log = self.logs[chat_id] = ChatLog(self.epoch)
+            if log.lines and (log.tokens + tokens > self.chunk_tokens or len(log.lines) >= self.chunk_messages):
+                self._seal(log)
+            log.seq += 1
+            log.lines.append(line)
+            log.tokens += tokens
+    
+    def _seal(self, log):
+        data = zlib.compress("\n".join(log.lines).encode("utf-8"))
+        log.blocks.append((log.seq - len(log.lines) + 1, log.seq, len(log.lines), data))
+        log.count += len(log.lines)
+        log.lines = []
+        log.tokens = 0
+        # 超出上限時丟棄最舊的塊
+        while log.blocks and log.count + len(log.lines) > self.max_messages:
+            log.count -= log.blocks.popleft()[2]
+    
+    def chunks(self, chat_id, limit):
+        """返回正好覆蓋最近 limit 條消息的塊：[(緩存key或None, 文本)]，完整包含的封存塊可緩存"""
+        if limit < 1:
+            return []
+        with self.lock:
+            log = self.logs.get(chat_id)
+            if not log:
+                return []
+            result = []  # (緩存key, 數據, 只取最後幾條)
+            remaining = limit
+            if log.lines:
+                result.append((None, "\n".join(log.lines[-remaining:]), None))
+                remaining -= len(log.lines)
+            for start, end, count, data in reversed(log.blocks):
+                if remaining <= 0:
+                    break
+                if count <= remaining:
+                    result.append(((chat_id, log.epoch, start, end), data, None))
+                else:
+                    result.append((None, data, remaining))
+                remaining -= count
+        
+        # 解壓放在鎖外；只取部分的塊不緩存
+        chunks = []
+        for key, data, take in result:
+            if isinstance(data, bytes):
+                data = zlib.decompress(data).decode("utf-8")
+                if take:
+                    data = "\n".join(data.split("\n")[-take:])
+            chunks.append((key, data))
+        chunks.reverse()
+        return chunks
+    
+    def stats(self):
+        with self.lock:
+            return {
+                "chats": len(self.enabled_chats),
+                "messages": sum(log.count + len(log.lines) for log in self.logs.values()),
+                "compressed_bytes": sum(len(block[3]) for log in self.logs.values() for block in log.blocks)
+            }
+
+class Summarizer:
+    """map-reduce 總結：分塊並行總結，再合併；封存塊的總結增量緩存"""
+    MAP_PROMPT = """以下是一段群組聊天記錄，請用繁體中文列出其中的重點（最多5點，每點一行，標出關鍵人物）：
+
+{text}"""
+    REDUCE_PROMPT = """以下是同一個群組不同時段的聊天重點，請按時間順序整合成一份簡潔的總結（最多10點）：
+
+{text}"""
+    
+    def __init__(self, ai, history, concurrency=3, cache_size=512):
+        self.ai = ai
+        self.history = history
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="summarize")
+        self.cache = OrderedDict()  # (chat_id, epoch, 起始序號, 結束序號) -> 部分總結
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+        self.stats = {"cache_hits": 0, "map_calls": 0, "reduce_calls": 0}
+    
+    def _map(self, key, text):
+        if key:
+            with self.lock:
+                if key in self.cache:
+                    self.cache.move_to_end(key)
+                    self.stats["cache_hits"] += 1
+                    return self.cache[key]
+        
+        self.stats["map_calls"] += 1
+        summary = self.ai.generate(self.MAP_PROMPT.format(text=text), max_output_tokens=300)
+        if summary and key:
+            with self.lock:
+                self.cache[key] = summary
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return summary
+    
+    def forget(self, chat_id):
+        """刪除群組的所有緩存總結（關閉記錄時調用）"""
+        with self.lock:
+            for key in [key for key in self.cache if key[0] == chat_id]:
+                del self.cache[key]
+    
+    def summarize(self, chat_id, limit):
+        """總結最近 limit 條消息，沒有記錄時返回 None"""
+        chunks = self.history.chunks(chat_id, limit)
+        if not chunks:
+            return None
+        
+        partials = [summary for summary in self.executor.map(lambda chunk: self._map(*chunk), chunks) if summary]
+        if not partials:
+            return AIService.FAILURE_REPLY
+        if len(partials) == 1:
+            return partials[0]
+        
+        self.stats["reduce_calls"] += 1
+        text = "\n\n".join(f"【第{i + 1}段】\n{partial}" for i, partial in enumerate(partials))
+        return self.ai.generate(self.REDUCE_PROMPT.format(text=text), max_output_tokens=600) or "\n".join(partials)
+    
+    def metrics(self):
+        with self.lock:
+            return dict(self.stats, cached=len(self.cache))
+
 # ========== 消息處理 ==========
 class MessageHandler:
-    def __init__(self, bot, ai_service):
+    BUSY_REPLY = "🚦 目前請求較多，請稍後再試"
+    TRIGGERS = ['!', '/ask', '/ai', '/gemini', '??']
+    KEYWORDS = ['機器人', 'bot', 'ai', '幫忙', '請問']
+    
+    def __init__(self, bot, ai_service, admission, identity, coalescer, history, media):
         self.bot = bot
         self.ai = ai_service
+        self.admission = admission
+        self.identity = identity
+        self.coalescer = coalescer
+        self.history = history
+        self.media = media
+        self.coalescer.on_flush = self.answer_batch
         self.cooldown_time = 3  # 冷卻時間（秒）
     
-    def should_respond(self, msg):
-        """檢查是否應該回應"""
-        chat_id = msg.chat.id
-        user_id = msg.from_user.id if msg.from_user else 0
-        
-        # 檢查私聊
-        if msg.chat.type == "private":
-            return False, "本機器人僅在群組中使用，請將我添加到群組中！"
-        
-        # 檢查冷卻
-        current_time = time.time()
-        if chat_id in user_cooldown:
-            last_time = user_cooldown[chat_id]
-            if current_time - last_time < self.cooldown_time:
-                return False, f"請等待 {int(self.cooldown_time - (current_time - last_time))} 秒後再試"
-        
-        # 檢查觸發條件
-        text = msg.text.strip()
-        triggered = False
+    @staticmethod
+    def message_text(msg):
+        """消息文本，圖片/文件取說明文字"""
+        return msg.text or msg.caption or ""
+    
+    def detect_trigger(self, text, reply_to_user_id=None):
+        """檢查觸發條件，返回 (優先級, 去掉觸發詞後的文本)，未觸發時優先級為 None"""
+        text = text.strip()
+        priority = None
         
         # 1. 回復機器人
-        if msg.reply_to_message and msg.reply_to_message.from_user.id == self.bot.get_me().id:
-            triggered = True
+        if reply_to_user_id is not None and reply_to_user_id == self.identity.id:
+            priority = PRIORITY_REPLY
         
         # 2. @機器人
-        bot_username = self.bot.get_me().username
+        bot_username = self.identity.username
         if bot_username and f"@{bot_username}" in text:
             text = text.replace(f"@{bot_username}", "").strip()
-            triggered = True
+            priority = PRIORITY_COMMAND
         
         # 3. 命令觸發
-        triggers = ['!', '/ask', '/ai', '/gemini', '??']
-        for trigger in triggers:
+        for trigger in self.TRIGGERS:
             if text.startswith(trigger):
                 text = text[len(trigger):].strip()
-                triggered = True
+                priority = PRIORITY_COMMAND
                 break
         
         # 4. 關鍵詞觸發（可選）
-        keywords = ['機器人', 'bot', 'ai', '幫忙', '請問']
-        if any(keyword in text.lower() for keyword in keywords):
-            triggered = True
+        if priority is None:
+            lowered = text.lower()
+            if any(keyword in lowered for keyword in self.KEYWORDS):
+                priority = PRIORITY_KEYWORD
+        
+        return priority, text
+    
+    def is_actionable(self, lite):
+        """webhook 快速路徑：判斷更新是否需要完整解析"""
+        if lite.text is None:
+            return False
+        # 開啟了歷史記錄的群組需要保留所有消息（前門不知道節點上 /summarize on 的開關，
+        # 只在 HISTORY_FORWARD_ALL 時轉發全部群組消息；多進程前門的突發記錄不在進程間共享，同樣轉發交給節點判斷）
+        if lite.chat_type != "private" and (self.history.is_enabled(lite.chat_id) or
+                                            (BOT_ROLE == "frontdoor" and
+                                             (HISTORY_FORWARD_ALL or (WORKERS > 1 and self.coalescer.enabled)))):
+            return True
+        # 同一用戶的突發後續消息，即使沒有觸發詞也要合併
+        if self.coalescer.has_pending(BurstCoalescer.key(lite.chat_id, lite.user_id, lite.thread_id)):
+            return True
+        # 私聊要回覆提示，命令交給命令處理器
+        if lite.chat_type == "private" or lite.text.startswith('/'):
+            return True
+        priority, _ = self.detect_trigger(lite.text, lite.reply_to_user_id)
+        return priority is not None
+    
+    def should_respond(self, msg):
+        """檢查是否應該回應"""
+        chat_id = msg.chat.id
+        
+        # 檢查私聊
+        if msg.chat.type == "private":
+            return False, "本機器人僅在群組中使用，請將我添加到群組中！", None
+        
+        # 檢查觸發條件（未觸發的普通聊天不提示冷卻）
+        reply_to = msg.reply_to_message
+        reply_to_user_id = reply_to.from_user.id if reply_to and reply_to.from_user else None
+        priority, text = self.detect_trigger(self.message_text(msg), reply_to_user_id)
         
-        if not triggered:
-            return False, None
+        if priority is None:
+            return False, None, None
+        
+        # 檢查冷卻
+        current_time = time.time()
+        if chat_id in user_cooldown:
+            last_time = user_cooldown[chat_id]
+            if current_time - last_time < self.cooldown_time:
+                return False, f"請等待 {int(self.cooldown_time - (current_time - last_time))} 秒後再試", None
         
         # 更新冷卻時間
         user_cooldown[chat_id] = current_time
         
-        return True, text
+        return True, text, priority
     
     def process_message(self, msg):
         """處理消息"""
-        should_respond, text = self.should_respond(msg)
+        has_media = self.media.enabled and MediaService.has_media(msg)
+        
+        # 已有等待合併的批次：直接加入，不檢查冷卻（帶圖片/文件的消息單獨回答）
+        if self.coalescer.enabled and msg.chat.type != "private" and not has_media:
+            reply_to = msg.reply_to_message
+            _, text = self.detect_trigger(self.message_text(msg), reply_to.from_user.id if reply_to and reply_to.from_user else None)
+            if text and SecurityUtils.is_safe_input(text) and self.coalescer.append(msg, SecurityUtils.sanitize_text(text)):
+                return
+        
+        should_respond, text, priority = self.should_respond(msg)
         
         if not should_respond:
             if text:  # 有錯誤消息
@@ -518,6 +2020,10 @@ class MessageHandler:
         # 清理文本
         text = SecurityUtils.sanitize_text(text)
         
+        if has_media:
+            self.answer(msg, text, priority, with_media=True)
+            return
+        
         # 嘗試數學計算
         if self.is_math_expression(text):
             try:
@@ -527,20 +2033,51 @@ class MessageHandler:
             except:
                 pass  # 不是數學表達式，繼續AI處理
         
-        # 顯示"思考中"
-        thinking_msg = self.bot.reply_to(msg, "🤔 思考中...")
+        # 等待一小段時間，合併同一用戶的連續消息
+        if self.coalescer.enabled:
+            self.coalescer.start(msg, text, priority)
+            return
         
-        # 獲取AI回應
-        response = self.ai.get_response(text, msg.chat.id)
+        self.answer(msg, text, priority)
+    
+    def answer_batch(self, messages, text, priority):
+        """回覆合併後的消息（回覆最後一條）"""
+        self.answer(messages[-1], text, priority)
+    
+    def answer(self, msg, text, priority, with_media=False):
+        """調用AI並回覆；with_media 時取得名額後才下載消息中的圖片/文件"""
+        # 准入控制：飽和時直接返回固定回覆（不下載和縮放文件）
+        if not self.admission.acquire(priority, saturated=self.ai.is_saturated()):
+            self.bot.reply_to(msg, self.BUSY_REPLY)
+            return
         
-        # 刪除"思考中"消息
         try:
-            self.bot.delete_message(msg.chat.id, thinking_msg.message_id)
-        except:
-            pass
-        
-        # 發送回應
-        self.send_safe_reply(msg, response)
+            media = None
+            if with_media:
+                try:
+                    media = self.media.get(msg)
+                except MediaError as e:
+                    self.bot.reply_to(msg, f"⚠️ {e}")
+                    return
+                text = text or MediaService.DEFAULT_PROMPTS[MediaService.label(media)]
+            
+            # 顯示"思考中"
+            thinking_msg = self.bot.reply_to(msg, "🤔 思考中...")
+            
+            # 獲取AI回應（按請求內容選擇生成配置）
+            profile = self.ai.profiles.classify(text, priority, media)
+            response = self.ai.get_response(text, msg.chat.id, media, profile)
+            
+            # 刪除"思考中"消息
+            try:
+                self.bot.delete_message(msg.chat.id, thinking_msg.message_id)
+            except:
+                pass
+            
+            # 發送回應
+            self.send_safe_reply(msg, response)
+        finally:
+            self.admission.release(priority)
     
     @staticmethod
     def is_math_expression(text):
@@ -573,7 +2110,7 @@ class MessageHandler:
                 try:
                     self.bot.reply_to(msg, text)
                 except Exception as e:
-                    logger.error(f"發送消息失敗: {e}")
+                    logger.error("發送消息失敗: %s", e)
                     self.bot.reply_to(msg, "抱歉，消息發送出錯")
         else:
             # 長消息處理
@@ -593,7 +2130,8 @@ class WebhookManager:
     def __init__(self, bot, domain):
         self.bot = bot
         self.domain = domain
-        self.env_info = detect_environment()
+        self.env_info = None  # 首次設置webhook時才檢測（需要網絡）
+        self.active = False
     
     def setup_webhook(self):
         """智能設置webhook"""
@@ -602,20 +2140,30 @@ class WebhookManager:
             return False
         
         try:
+            if self.env_info is None:
+                self.env_info = detect_environment()
+            
             # 等待避免API限制
             time.sleep(5)
             
-            # 移除現有webhook
-            self.bot.remove_webhook()
-            time.sleep(2)
-            
             # 構建webhook URL
             if not self.domain.startswith(("http://", "https://")):
                 webhook_url = f"https://{self.domain}/webhook"
             else:
                 webhook_url = f"{self.domain}/webhook"
             
-            logger.info(f"設置webhook到: {webhook_url}")
+            # 已指向同一地址時不重設（滾動重啟時避免丟棄待處理更新）
+            current = self.get_webhook_info()
+            if current and current.url == webhook_url:
+                logger.info("Webhook已指向 %s，無需重設", webhook_url)
+                self.active = True
+                return True
+            
+            # 移除現有webhook
+            self.bot.remove_webhook()
+            time.sleep(2)
+            
+            logger.info("設置webhook到: %s", webhook_url)
             
             # 根據環境選擇策略
             webhook_params = {
@@ -633,7 +2181,7 @@ class WebhookManager:
                 public_ip = NetworkUtils.get_public_ip()
                 if public_ip and ':' not in public_ip:  # IPv4地址
                     webhook_params["ip_address"] = public_ip
-                    logger.info(f"使用IPv4地址: {public_ip}")
+                    logger.info("使用IPv4地址: %s", public_ip)
                 else:
                     logger.warning("無法獲取IPv4地址，嘗試不使用ip_address參數")
             
@@ -644,12 +2192,13 @@ class WebhookManager:
                     
                     if success:
                         logger.info("✅ Webhook設置成功")
+                        self.active = True
                         
                         # 驗證webhook
                         time.sleep(2)
                         webhook_info = self.bot.get_webhook_info()
-                        logger.info(f"Webhook信息: {webhook_info.url}")
-                        logger.info(f"待處理更新: {webhook_info.pending_update_count}")
+                        logger.info("Webhook信息: %s", webhook_info.url)
+                        logger.info("待處理更新: %s", webhook_info.pending_update_count)
                         
                         return True
                     else:
@@ -660,17 +2209,17 @@ class WebhookManager:
                     error_msg = str(e)
                     if "429" in error_msg:
                         wait_time = 10 * (attempt + 1)
-                        logger.warning(f"API限制，等待{wait_time}秒")
+                        logger.warning("API限制，等待%s秒", wait_time)
                         time.sleep(wait_time)
                     else:
-                        logger.error(f"設置webhook錯誤: {e}")
+                        logger.error("設置webhook錯誤: %s", e)
                         break
             
             logger.error("❌ Webhook設置失敗")
             return False
             
         except Exception as e:
-            logger.error(f"Webhook設置過程出錯: {e}")
+            logger.error("Webhook設置過程出錯: %s", e)
             return False
     
     def get_webhook_info(self):
@@ -680,47 +2229,564 @@ class WebhookManager:
         except:
             return None
 
+# ========== 狀態快照 ==========
+START_TIME = time.time()
+
+class StatusSnapshot:
+    """後台定期匯總狀態，/、/status、/health 直接讀內存，不在請求中做網絡I/O"""
+    def __init__(self, interval=5, env_interval=600):
+        self.interval = interval          # 刷新間隔（秒）
+        self.env_interval = env_interval  # 環境檢測間隔（需要網絡，較慢）
+        self.env_info = None
+        self.env_checked = 0
+        self.refreshed = 0
+        self.data = None
+        self.index_json = None
+        self.status_text = None
+        self.ready = (False, {})
+        self.thread = None
+        self.lock = threading.Lock()
+    
+    def start(self):
+        self.thread = threading.Thread(target=self._loop, name="status-snapshot", daemon=True)
+        self.thread.start()
+    
+    def _loop(self):
+        while True:
+            try:
+                self.refresh(with_env=True)
+            except Exception as e:
+                logger.error("刷新狀態快照失敗: %s", e)
+            time.sleep(self.interval)
+    
+    def environment(self):
+        return self.env_info or {"ipv4": None, "ipv6": None, "docker": os.path.exists("/.dockerenv"),
+                                 "cloud": None, "public_ip": None, "local_ip": None}
+    
+    def refresh(self, with_env=False):
+        """重新匯總狀態並預先生成各端點的響應"""
+        now = time.time()
+        if with_env and now - self.env_checked > self.env_interval:
+            self.env_info = detect_environment()
+            self.env_checked = now
+        env_info = self.environment()
+        
+        admission_metrics = admission.metrics()
+        keys = key_pool.stats()
+        data = {
+            "status": "running",
+            "timestamp": datetime.now().isoformat(),
+            "uptime": int(now - START_TIME),
+            "role": BOT_ROLE,
+            "environment": env_info,
+            "config": {
+                "has_token": bool(BOT_TOKEN),
+                "has_key": bool(GEMINI_API_KEY),
+                "domain": DOMAIN,
+                "port": PORT
+            },
+            "models": {
+                "profiles": {name: ai_service.select_model(profile) for name, profile in ai_service.profiles.profiles.items()},
+                "saturated": ai_service.is_saturated(),
+                "quota_errors": {name: round(now - at) for name, at in ai_service.quota_errors.items()}
+            },
+            "api_keys": {"total": len(keys), "available": key_pool.available()},
+            "queue": {
+                "inflight": admission_metrics["inflight"],
+                "capacity": admission_metrics["capacity"],
+                "depth": admission_metrics["queue_depth"]
+            },
+            "caches": {
+                "context_chats": len(context_cache),
+                "cooldown_chats": len(user_cooldown),
+                "pending_bursts": coalescer.metrics()["pending"],
+                "history": group_history.stats(),
+                "summaries": summarizer.metrics()["cached"],
+                "media_bytes": media_service.metrics()["cached_bytes"]
+            },
+            "webhook": dict(webhook_stats, active=webhook_manager.active, inflight=update_dispatcher.inflight),
+            "log_dropped": NonBlockingQueueHandler.dropped
+        }
+        
+        status_text = f"""📊 *機器人狀態*
+
+*基本信息:*
+• 更新時間: {datetime.fromtimestamp(now).strftime('%Y-%m-%d %H:%M:%S')}
+• 已運行: {data['uptime'] // 3600}小時{data['uptime'] % 3600 // 60}分
+• 對話緩存: {len(context_cache)} 個聊天
+• 模型: {', '.join(f"{name}→{model}" for name, model in data['models']['profiles'].items())}
+• API Key: {data['api_keys']['available']}/{data['api_keys']['total']} 可用
+
+*網絡環境:*
+• IPv4: {'✅ 可用' if env_info['ipv4'] else '❌ 不可用'}
+• IPv6: {'✅ 可用' if env_info['ipv6'] else '❌ 不可用'}
+• 公網IP: {env_info['public_ip'] or '未知'}
+• Docker: {'✅ 是' if env_info['docker'] else '❌ 否'}
+
+*配置信息:*
+• Webhook域名: {DOMAIN or '未設置'}
+• 服務端口: {PORT}
+• 冷卻時間: {message_handler.cooldown_time}秒
+
+*請求隊列:*
+• 處理中: {data['queue']['inflight']}/{data['queue']['capacity']}
+• 排隊中: {data['queue']['depth']}"""
+        
+        ready, checks = self._readiness(data)
+        with self.lock:
+            self.data = data
+            self.index_json = json.dumps(data, indent=2, ensure_ascii=False)
+            self.status_text = status_text
+            self.ready = (ready, checks)
+            self.refreshed = now
+    
+    @staticmethod
+    def _readiness(data):
+        checks = {
+            # 更新線程池可用且未在排空
+            "worker_pool": update_dispatcher.accepting,
+            # 至少有一個 Key 有額度，且不是所有模型都在配額錯誤中
+            "upstream": not data["models"]["saturated"],
+            # 隊列未滿
+            "queue": data["queue"]["depth"] < admission.max_queue
+        }
+        if BOT_ROLE == "frontdoor":
+            checks["shards"] = bool(shard_router and shard_router.ring.nodes)
+        elif BOT_ROLE == "standalone" and DOMAIN:
+            checks["webhook"] = data["webhook"]["active"]
+        return all(checks.values()), checks
+    
+    def ensure(self):
+        """後台線程未啟動時（如測試）同步生成一次，不做環境檢測"""
+        if self.data is None:
+            self.refresh(with_env=False)
+    
+    def get_index(self):
+        self.ensure()
+        return self.index_json
+    
+    def get_status_text(self):
+        self.ensure()
+        return self.status_text
+    
+    def liveness(self):
+        """存活：快照線程仍在刷新"""
+        self.ensure()
+        age = time.time() - self.refreshed
+        alive = self.thread is None or (self.thread.is_alive() and age < self.interval * 3 + 30)
+        return alive, {"status": "alive" if alive else "stale", "snapshot_age": round(age, 1)}
+    
+    def readiness(self):
+        """就緒：工作線程、上游和隊列狀態都正常"""
+        alive, live_info = self.liveness()
+        with self.lock:
+            ready, checks = self.ready
+        ready = ready and alive
+        return ready, {"status": "ready" if ready else "not_ready", "checks": checks,
+                       "snapshot_age": live_info["snapshot_age"]}
+
+# ========== 多進程服務 ==========
+draining = threading.Event()
+
+class UpdateDispatcher:
+    """把 webhook 更新交給線程池處理，並統計處理中的數量"""
+    def __init__(self, bot, threads=16):
+        self.bot = bot
+        self.threads = threads
+        self.executor = None
+        self.inflight = 0
+        self.stopped = False
+        self.lock = threading.Lock()
+    
+    def start(self):
+        self.executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="update")
+        self.inflight = 0
+        self.stopped = False
+    
+    @property
+    def accepting(self):
+        """線程池可用且未在排空"""
+        return not self.stopped and not draining.is_set()
+    
+    def dispatch(self, update):
+        if self.executor is None:
+            self.start()
+        with self.lock:
+            self.inflight += 1
+        try:
+            self.executor.submit(self._run, update)
+        except RuntimeError:
+            # 線程池已關閉（進程退出中）：交給 webhook 返回錯誤，讓 Telegram 重發
+            with self.lock:
+                self.inflight -= 1
+                self.stopped = True
+            raise
+    
+    def stop(self):
+        """關閉線程池（排空之後調用）"""
+        self.stopped = True
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+    
+    def _run(self, update):
+        try:
+            self.bot.process_new_updates([update])
+        except Exception as e:
+            logger.error("處理更新錯誤: %s", e)
+        finally:
+            with self.lock:
+                self.inflight -= 1
+    
+    def idle(self):
+        """沒有處理中的更新、合併批次和 AI 請求"""
+        return self.inflight == 0 and coalescer.idle() and admission.inflight == 0 and not admission.waiting
+    
+    def drain(self, timeout=30):
+        """等待處理中的請求完成"""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.idle():
+                return True
+            time.sleep(0.2)
+        return False
+
+class LogCollector:
+    """多進程主進程：接收工作進程的日誌數據報，寫入主進程的日誌文件"""
+    def __init__(self, file_handler):
+        self.file_handler = file_handler
+        self.recv_sock, self.send_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.thread = threading.Thread(target=self._loop, name="log-collector", daemon=True)
+        self.thread.start()
+    
+    @property
+    def fd(self):
+        """傳給工作進程的發送端"""
+        return self.send_sock.fileno()
+    
+    def _loop(self):
+        while True:
+            try:
+                data = self.recv_sock.recv(65536)
+                self.file_handler.handle(logging.makeLogRecord({"preformatted": data.decode("utf-8", "replace")}))
+            except Exception as e:
+                print(f"接收工作進程日誌失敗: {e}", file=sys.stderr)
+
+class PreforkServer:
+    """SO_REUSEPORT 多進程：每個子進程獨立監聽同一端口，內核分配連接"""
+    def __init__(self, port, workers, drain_timeout=30, ready_timeout=60):
+        self.port = port
+        self.workers = workers
+        self.drain_timeout = drain_timeout
+        self.ready_timeout = ready_timeout  # 等待新進程開始監聽的時間
+        self.children = {}  # pid -> 編號
+        self.logs = None     # 主進程的日誌收集器（配置了日誌文件時）
+        self.stopping = False
+        self.restart_requested = False
+    
+    # ----- 主進程 -----
+    def run(self):
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_restart)
+        
+        file_handler = next((h for h in log_listener.handlers if isinstance(h, logging.FileHandler)), None)
+        if file_handler:
+            self.logs = LogCollector(file_handler)
+        
+        for index in range(self.workers):
+            pid, ready_fd = self.spawn(index)
+            os.close(ready_fd)
+        logger.info("已啟動 %d 個工作進程（SIGHUP 滾動重啟，SIGTERM 排空後退出）", self.workers)
+        
+        while self.children:
+            if self.restart_requested:
+                self.restart_requested = False
+                self.rolling_restart()
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                time.sleep(0.5)
+                continue
+            index = self.children.pop(pid, None)
+            if index is not None and not self.stopping:
+                logger.warning("工作進程 %d 意外退出（%s），重新啟動", pid, status)
+                time.sleep(1)
+                pid, ready_fd = self.spawn(index)
+                os.close(ready_fd)
+        logger.info("所有工作進程已退出")
+    
+    def spawn(self, index):
+        """fork + exec 重新啟動 main.py（重新加載代碼和配置），返回 (pid, 就緒通知管道讀端)"""
+        ready_read, ready_write = os.pipe()
+        env = dict(os.environ, PREFORK_WORKER=str(index), PREFORK_READY_FD=str(ready_write),
+                   PREFORK_WEBHOOK_ACTIVE="1" if webhook_manager.active else "0")
+        if self.logs:
+            env["PREFORK_LOG_FD"] = str(self.logs.fd)
+        args = [sys.executable, os.path.abspath(sys.argv[0])] + sys.argv[1:]
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(ready_read)
+                os.set_inheritable(ready_write, True)
+                if self.logs:
+                    os.set_inheritable(self.logs.fd, True)
+                os.execve(sys.executable, args, env)
+            finally:
+                os._exit(1)
+        os.close(ready_write)
+        self.children[pid] = index
+        return pid, ready_read
+    
+    def wait_ready(self, ready_fd):
+        """等待子進程通過管道報告已開始監聽（子進程退出時管道關閉，返回 False）"""
+        try:
+            readable, _, _ = select.select([ready_fd], [], [], self.ready_timeout)
+            return bool(readable) and os.read(ready_fd, 1) == b"1"
+        finally:
+            os.close(ready_fd)
+    
+    def rolling_restart(self):
+        """逐個替換：先啟動新進程，確認開始監聽後再讓舊進程排空退出"""
+        logger.info("開始滾動重啟")
+        for pid, index in list(self.children.items()):
+            new_pid, ready_fd = self.spawn(index)
+            if not self.wait_ready(ready_fd):
+                logger.error("新工作進程 %d 未能在 %s 秒內就緒，停止滾動重啟並保留舊進程", new_pid, self.ready_timeout)
+                try:
+                    os.kill(new_pid, signal.SIGKILL)
+                    os.waitpid(new_pid, 0)
+                except (ProcessLookupError, ChildProcessError):
+                    pass
+                self.children.pop(new_pid, None)
+                return
+            os.kill(pid, signal.SIGTERM)
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+            self.children.pop(pid, None)
+        logger.info("滾動重啟完成")
+    
+    def _on_stop(self, signum, frame):
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    
+    def _on_restart(self, signum, frame):
+        self.restart_requested = True
+    
+    # ----- 子進程 -----
+    def serve_child(self, index, ready_fd=None):
+        # 由主進程 exec 啟動：中斷和重啟信號只由主進程處理
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        # webhook 由主進程設置，子進程沿用其結果作為就緒檢查
+        webhook_manager.active = os.getenv("PREFORK_WEBHOOK_ACTIVE") == "1"
+        update_dispatcher.start()
+        if shard_router:
+            shard_router.start()
+        status_snapshot.start()
+        
+        # 綁定到固定 CPU
+        if hasattr(os, "sched_setaffinity"):
+            cpus = sorted(os.sched_getaffinity(0))
+            os.sched_setaffinity(0, {cpus[index % len(cpus)]})
+        
+        server = make_reuseport_server(self.port)
+        
+        def on_term(signum, frame):
+            # 停止接受新連接（在其他線程中調用，避免阻塞 serve_forever）
+            draining.set()
+            threading.Thread(target=server.shutdown, daemon=True).start()
+        signal.signal(signal.SIGTERM, on_term)
+        
+        logger.info("工作進程 %d 監聽 0.0.0.0:%d", os.getpid(), self.port)
+        if ready_fd is not None:
+            # 通知主進程已開始監聽（連接會在監聽隊列中等待 serve_forever）；主進程不等待時管道已關閉
+            try:
+                os.write(ready_fd, b"1")
+            except BrokenPipeError:
+                pass
+            os.close(ready_fd)
+        server.serve_forever()
+        server.server_close()
+        
+        if update_dispatcher.drain(self.drain_timeout):
+            logger.info("工作進程 %d 已處理完所有請求，退出", os.getpid())
+        else:
+            logger.warning("工作進程 %d 排空超時，仍有請求未完成", os.getpid())
+        update_dispatcher.stop()
+
+def make_reuseport_server(port):
+    """創建帶 SO_REUSEPORT 的監聽 socket 並交給 werkzeug"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(("0.0.0.0", port))
+    sock.listen(128)
+    server = make_server("0.0.0.0", port, app, threaded=True, fd=sock.fileno())
+    sock.close()  # make_server 已複製文件描述符
+    return server
+
 # ========== Flask 路由 ==========
 # 初始化服務
-ai_service = AIService(GEMINI_API_KEY)
-message_handler = MessageHandler(bot, ai_service)
+try:
+    generation_overrides = ProfileRouter.parse_overrides(os.getenv("GENERATION_PROFILES"))
+except ValueError as e:
+    logger.error("❌ GENERATION_PROFILES 配置錯誤: %s", e)
+    sys.exit(1)
+
+# 多進程時每個工作進程各自計數，Key 配額和並發上限按進程數平分，總量不超過配置值
+PROCESS_SHARE = WORKERS if os.getenv("PREFORK_WORKER") is not None and WORKERS > 1 else 1
+
+def per_process(limit):
+    """按進程數平分限制（0 表示不限制，保持不變）"""
+    return max(1, limit // PROCESS_SHARE) if limit > 0 else limit
+
+key_pool = ApiKeyPool(
+    GEMINI_API_KEYS,
+    rpm=per_process(GEMINI_RPM),
+    tpm=per_process(GEMINI_TPM),
+    endpoint=GEMINI_API_ENDPOINT
+)
+ai_service = AIService(key_pool, PromptBudget(
+    chat_budget=int(os.getenv("PROMPT_TOKEN_BUDGET", 3000)),
+    exact_count=os.getenv("PROMPT_EXACT_TOKENS", "").lower() in ("1", "true", "yes")
+), ProfileRouter(generation_overrides))
+admission = AdmissionController(
+    capacity=per_process(int(os.getenv("AI_MAX_CONCURRENCY", 4))),
+    max_queue=int(os.getenv("AI_MAX_QUEUE", 32)),
+    queue_timeout=float(os.getenv("AI_QUEUE_TIMEOUT", 15))
+)
+bot_identity = BotIdentity(bot)
+shard_router = ShardRouter(SHARD_NODES, SHARD_SECRET) if BOT_ROLE == "frontdoor" else None
+# 多進程時內核把更新隨機分給各進程，同一群組的消息不在同一進程中：
+# 突發合併和群組歷史需要看到全部消息，因此只在單進程（或前門，只做轉發判斷）時啟用
+SHARED_CHAT_STATE = WORKERS <= 1 or BOT_ROLE == "frontdoor"
+coalescer = BurstCoalescer(
+    window=float(os.getenv("DEBOUNCE_SECONDS", 1.5)) if SHARED_CHAT_STATE else 0,
+    max_wait=float(os.getenv("DEBOUNCE_MAX_SECONDS", 6)),
+    max_messages=int(os.getenv("DEBOUNCE_MAX_MESSAGES", 5))
+)
+group_history = GroupHistory(
+    max_messages=int(os.getenv("HISTORY_MAX_MESSAGES", 2000)) if SHARED_CHAT_STATE else 0,
+    chunk_tokens=int(os.getenv("SUMMARY_CHUNK_TOKENS", 1500)),
+    chats=[int(chat) for chat in os.getenv("HISTORY_CHATS", "").split(",") if chat.strip()]
+)
+# 前門轉發全部群組消息，使節點上用 /summarize on 開啟的群組也能記錄（默認只轉發 HISTORY_CHATS）
+HISTORY_FORWARD_ALL = group_history.available and os.getenv("HISTORY_FORWARD_ALL", "").lower() in ("1", "true", "yes")
+summarizer = Summarizer(
+    ai_service, group_history,
+    concurrency=int(os.getenv("SUMMARY_CONCURRENCY", 3))
+)
+media_service = MediaService(
+    bot,
+    target_px=int(os.getenv("MEDIA_TARGET_PX", 1024)),
+    max_bytes=int(float(os.getenv("MEDIA_MAX_MB", 10)) * 1024 * 1024),
+    cache_bytes=int(float(os.getenv("MEDIA_CACHE_MB", 64)) * 1024 * 1024),
+    workers=int(os.getenv("MEDIA_WORKERS", 2))
+)
+message_handler = MessageHandler(bot, ai_service, admission, bot_identity, coalescer, group_history, media_service)
 webhook_manager = WebhookManager(bot, DOMAIN)
+update_dispatcher = UpdateDispatcher(bot, WORKER_THREADS)
+status_snapshot = StatusSnapshot(
+    interval=float(os.getenv("STATUS_REFRESH_SECONDS", 5)),
+    env_interval=float(os.getenv("ENV_REFRESH_SECONDS", 600))
+)
 
 @app.route("/")
 def index():
     """首頁"""
-    env_info = detect_environment()
-    
-    info = {
-        "status": "running",
-        "timestamp": datetime.now().isoformat(),
-        "environment": env_info,
-        "config": {
-            "has_token": bool(BOT_TOKEN),
-            "has_key": bool(GEMINI_API_KEY),
-            "domain": DOMAIN,
-            "port": PORT
-        }
-    }
-    
-    return json.dumps(info, indent=2, ensure_ascii=False)
+    return status_snapshot.get_index(), 200, {"Content-Type": "application/json"}
 
 @app.route("/health")
+@app.route("/health/live")
 def health():
-    """健康檢查"""
-    return json.dumps({"status": "healthy", "time": datetime.now().isoformat()})
+    """健康檢查（存活）"""
+    alive, info = status_snapshot.liveness()
+    info["time"] = datetime.now().isoformat()
+    return json.dumps(info), 200 if alive else 503, {"Content-Type": "application/json"}
+
+@app.route("/health/ready")
+def health_ready():
+    """健康檢查（就緒）"""
+    ready, info = status_snapshot.readiness()
+    info["time"] = datetime.now().isoformat()
+    return json.dumps(info), 200 if ready else 503, {"Content-Type": "application/json"}
+
+@app.route("/metrics")
+def metrics():
+    """隊列指標"""
+    return json.dumps({
+        "timestamp": datetime.now().isoformat(),
+        "admission": admission.metrics(),
+        "api_keys": key_pool.stats(),
+        "webhook": dict(webhook_stats),
+        "coalescer": coalescer.metrics(),
+        "history": dict(group_history.stats(), summaries=summarizer.metrics()),
+        "media": media_service.metrics(),
+        "profiles": ai_service.profiles.metrics(),
+        "shards": shard_router.metrics() if shard_router else None
+    }, indent=2, ensure_ascii=False)
+
+@app.route("/shard/nodes", methods=["GET", "POST"])
+def shard_nodes():
+    """查看或修改分片節點（僅前門模式）"""
+    if not shard_router:
+        return json.dumps({"error": "未啟用前門模式"}), 404
+    
+    if request.method == "POST":
+        # 修改節點必須配置並提供 SHARD_SECRET，否則任何人都能加入節點接收消息
+        if not SHARD_SECRET or request.headers.get("X-Shard-Secret") != SHARD_SECRET:
+            abort(403)
+        data = request.get_json(silent=True) or {}
+        node = (data.get("node") or "").rstrip("/")
+        if not node:
+            return json.dumps({"error": "缺少node"}), 400
+        if data.get("action") == "leave":
+            shard_router.leave(node, forget=True)
+        else:
+            shard_router.join(node)
+    
+    return json.dumps(shard_router.metrics(), indent=2, ensure_ascii=False)
 
 @app.route("/webhook", methods=["POST"])
 def webhook():
     """Telegram webhook"""
     if request.headers.get("content-type") == "application/json":
+        # 分片節點只接受前門轉發的請求
+        if BOT_ROLE == "worker" and SHARD_SECRET and request.headers.get("X-Shard-Secret") != SHARD_SECRET:
+            abort(403)
+        
         try:
-            json_str = request.get_data().decode('utf-8')
-            update = telebot.types.Update.de_json(json_str)
-            bot.process_new_updates([update])
+            # 快速路徑：先解析原始字節，不需要處理的更新不構建對象
+            raw = request.get_data()
+            lite = UpdateLite.parse(raw)
+            webhook_stats["received"] += 1
+            if not message_handler.is_actionable(lite):
+                webhook_stats["dropped"] += 1
+                return "ok"
+            
+            # 前門模式：按 chat_id 轉發到負責的節點
+            if shard_router:
+                # 隊列已滿或沒有可用節點時返回 503，讓 Telegram 稍後重發
+                if not shard_router.route(lite.chat_id if lite.chat_id is not None else lite.update_id, raw):
+                    return "unavailable", 503
+                if lite.chat_type != "private" and coalescer.enabled:
+                    coalescer.touch(BurstCoalescer.key(lite.chat_id, lite.user_id, lite.thread_id))
+                return "ok"
+            
+            update = telebot.types.Update.de_json(lite.data)
+            update_dispatcher.dispatch(update)
+            webhook_stats["processed"] += 1
             return "ok"
         except Exception as e:
-            logger.error(f"處理webhook錯誤: {e}")
+            logger.error("處理webhook錯誤: %s", e)
             return "error", 500
     abort(403)
 
@@ -739,7 +2805,7 @@ def set_webhook():
                 "pending_updates": info.pending_update_count if info else 0,
                 "last_error": info.last_error_message if info else None
             },
-            "environment": detect_environment()
+            "environment": status_snapshot.environment()
         }
         
         return json.dumps(response, indent=2, ensure_ascii=False)
@@ -784,6 +2850,7 @@ def send_help(msg):
 • 在群組中 @我 + 問題
 • 回覆我的消息進行對話
 • 使用命令 /ask + 問題
+• 發送圖片/文件並在說明中 @我 提問
 • 直接輸入數學表達式計算
 
 *可用命令:*
@@ -792,6 +2859,7 @@ def send_help(msg):
 /clear - 清除對話歷史
 /test - 測試AI回應
 /math 2+2 - 數學計算
+/summarize [N] - 總結最近N條消息（/summarize on 開啟記錄）
 
 *注意事項:*
 • 本機器人僅在群組中工作
@@ -807,27 +2875,7 @@ def send_help(msg):
 @bot.message_handler(commands=['status', '狀態'])
 def send_status(msg):
     """狀態命令"""
-    env_info = detect_environment()
-    
-    status_text = f"""📊 *機器人狀態*
-
-*基本信息:*
-• 運行時間: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
-• 對話緩存: {len(context_cache)} 個聊天
-• 當前模型: {MODEL_POOL[ai_service.current_model_index]}
-
-*網絡環境:*
-• IPv4: {'✅ 可用' if env_info['ipv4'] else '❌ 不可用'}
-• IPv6: {'✅ 可用' if env_info['ipv6'] else '❌ 不可用'}
-• 公網IP: {env_info['public_ip'] or '未知'}
-• Docker: {'✅ 是' if env_info['docker'] else '❌ 否'}
-
-*配置信息:*
-• Webhook域名: {DOMAIN or '未設置'}
-• 服務端口: {PORT}
-• 冷卻時間: {message_handler.cooldown_time}秒"""
-    
-    bot.reply_to(msg, status_text, parse_mode='Markdown')
+    bot.reply_to(msg, status_snapshot.get_status_text(), parse_mode='Markdown')
 
 @bot.message_handler(commands=['clear', '清除'])
 def clear_history(msg):
@@ -882,13 +2930,88 @@ def calculate_math(msg):
     except Exception as e:
         bot.reply_to(msg, f"❌ 發生錯誤: {str(e)}")
 
-@bot.message_handler(func=lambda message: True)
+def is_chat_admin(chat_id, user):
+    """用戶是否為群組管理員（查詢失敗時視為否）"""
+    if user is None:
+        return False
+    try:
+        return bot.get_chat_member(chat_id, user.id).status in ("administrator", "creator")
+    except Exception as e:
+        logger.warning("查詢群組成員失敗: %s", e)
+        return False
+
+@bot.message_handler(commands=['summarize', '總結'])
+def summarize_history(msg):
+    """群組消息總結"""
+    chat_id = msg.chat.id
+    if msg.chat.type == "private":
+        bot.reply_to(msg, "本命令僅在群組中使用")
+        return
+    if not group_history.available:
+        bot.reply_to(msg, "ℹ️ 消息記錄功能未啟用")
+        return
+    
+    parts = msg.text.split(maxsplit=1)
+    arg = parts[1].strip().lower() if len(parts) > 1 else ""
+    
+    # 開關記錄會影響所有成員的消息，只允許管理員操作
+    if arg in ("on", "開啟", "off", "關閉") and not is_chat_admin(chat_id, msg.from_user):
+        bot.reply_to(msg, "⛔ 只有群組管理員可以開啟或關閉消息記錄")
+        return
+    
+    if arg in ("on", "開啟"):
+        group_history.enable(chat_id)
+        bot.reply_to(msg, f"✅ 已開啟消息記錄（最多保留 {group_history.max_messages} 條），使用 /summarize off 關閉並刪除記錄")
+        return
+    if arg in ("off", "關閉"):
+        group_history.disable(chat_id)
+        summarizer.forget(chat_id)
+        bot.reply_to(msg, "✅ 已關閉消息記錄並刪除已保存的內容")
+        return
+    if not group_history.is_enabled(chat_id):
+        bot.reply_to(msg, "ℹ️ 本群組未開啟消息記錄，使用 /summarize on 開啟")
+        return
+    
+    if arg and not arg.isdigit():
+        bot.reply_to(msg, "用法: /summarize [條數] | on | off")
+        return
+    limit = min(int(arg) if arg else 200, group_history.max_messages)
+    if limit < 1:
+        bot.reply_to(msg, "用法: /summarize [條數] | on | off（條數至少為 1）")
+        return
+    
+    if not admission.acquire(PRIORITY_COMMAND, saturated=ai_service.is_saturated()):
+        bot.reply_to(msg, MessageHandler.BUSY_REPLY)
+        return
+    try:
+        thinking = bot.reply_to(msg, f"📝 正在總結最近 {limit} 條消息...")
+        summary = summarizer.summarize(chat_id, limit)
+        try:
+            bot.delete_message(chat_id, thinking.message_id)
+        except:
+            pass
+        if summary is None:
+            bot.reply_to(msg, "ℹ️ 還沒有記錄到消息")
+            return
+        message_handler.send_safe_reply(msg, f"📝 最近 {limit} 條消息總結：\n\n{summary}")
+    finally:
+        admission.release(PRIORITY_COMMAND)
+
+@bot.message_handler(func=lambda message: True, content_types=['text', 'photo', 'document'])
 def handle_all_messages(msg):
     """處理所有消息"""
     try:
+        # 記錄開啟了歷史記錄的群組消息
+        if group_history.is_enabled(msg.chat.id):
+            name = msg.from_user.first_name if msg.from_user else "?"
+            text = MessageHandler.message_text(msg)
+            if MediaService.has_media(msg):
+                text = f"[{'圖片' if msg.photo else '文件'}] {text}".strip()
+            group_history.record(msg.chat.id, name, text, msg.date)
+        
         message_handler.process_message(msg)
     except Exception as e:
-        logger.error(f"處理消息錯誤: {e}")
+        logger.error("處理消息錯誤: %s", e)
         try:
             bot.reply_to(msg, "⚠️ 處理消息時出錯，請稍後再試")
         except:
@@ -897,32 +3020,48 @@ def handle_all_messages(msg):
 # ========== 主程序 ==========
 def main():
     """主程序入口"""
+    # 多進程模式下由主進程啟動的工作進程
+    if os.getenv("PREFORK_WORKER") is not None:
+        PreforkServer(PORT, WORKERS, drain_timeout=float(os.getenv("DRAIN_TIMEOUT", 30))).serve_child(
+            int(os.environ["PREFORK_WORKER"]), int(os.environ["PREFORK_READY_FD"]))
+        return
+    
     logger.info("=" * 50)
     logger.info("🚀 啟動 Telegram Gemini Bot")
     logger.info("=" * 50)
     
     # 顯示配置信息（安全）
-    logger.info(f"BOT_TOKEN: {'*' * len(BOT_TOKEN) if BOT_TOKEN else '未設置'}")
-    logger.info(f"GEMINI_API_KEY: {'*' * len(GEMINI_API_KEY) if GEMINI_API_KEY else '未設置'}")
-    logger.info(f"DOMAIN: {DOMAIN or '未設置'}")
-    logger.info(f"PORT: {PORT}")
-    
-    # 檢測環境
-    env_info = detect_environment()
-    logger.info(f"環境檢測: IPv4={env_info['ipv4']}, IPv6={env_info['ipv6']}, Docker={env_info['docker']}")
-    logger.info(f"公網IP: {env_info['public_ip'] or '未知'}")
-    
-    # 檢查端口
-    if not NetworkUtils.check_port(PORT):
-        logger.warning(f"端口 {PORT} 可能被佔用，嘗試使用其他端口")
-        for alt_port in [8081, 8088, 8888, 3000]:
-            if NetworkUtils.check_port(alt_port):
-                PORT = alt_port
-                logger.info(f"改用端口: {PORT}")
-                break
+    logger.info("BOT_TOKEN: %s", '*' * len(BOT_TOKEN) if BOT_TOKEN else '未設置')
+    logger.info("GEMINI_API_KEY: %s", '*' * len(GEMINI_API_KEY) if GEMINI_API_KEY else '未設置')
+    logger.info("API Key數量: %d", len(GEMINI_API_KEYS))
+    logger.info("DOMAIN: %s", DOMAIN or '未設置')
+    logger.info("PORT: %s", PORT)
+    logger.info("ROLE: %s", BOT_ROLE)
     
-    # 設置webhook
-    if DOMAIN:
+    # 檢測環境（同時作為狀態快照的首次數據）
+    status_snapshot.refresh(with_env=True)
+    env_info = status_snapshot.environment()
+    logger.info("環境檢測: IPv4=%s, IPv6=%s, Docker=%s", env_info['ipv4'], env_info['ipv6'], env_info['docker'])
+    logger.info("公網IP: %s", env_info['public_ip'] or '未知')
+    
+    serving = bool(DOMAIN) or BOT_ROLE == "worker"
+    
+    # 檢查端口：Webhook 已按此端口註冊，被佔用時直接退出，不改用其他端口
+    if serving and not NetworkUtils.check_port(PORT, reuse_port=WORKERS > 0):
+        logger.error("❌ 端口 %s 已被佔用，請釋放端口或使用 --port 指定", PORT)
+        sys.exit(1)
+    
+    # 前門模式檢查節點（多進程時在子進程中啟動轉發）
+    if shard_router:
+        if not SHARD_NODES:
+            logger.error("❌ 前門模式需要設置 SHARD_NODES")
+            sys.exit(1)
+        logger.info("分片節點: %s", ', '.join(SHARD_NODES))
+    
+    # 設置webhook（分片節點由前門接收，不設置）
+    if BOT_ROLE == "worker":
+        logger.info("分片節點模式，跳過Webhook設置")
+    elif DOMAIN:
         logger.info("設置Webhook...")
         if webhook_manager.setup_webhook():
             logger.info("✅ Webhook設置完成")
@@ -931,25 +3070,40 @@ def main():
     else:
         logger.warning("⚠️ 未設置DOMAIN，使用輪詢模式（不推薦）")
     
+    # 多進程模式：主進程只負責管理子進程
+    if serving and WORKERS > 0:
+        if not SHARED_CHAT_STATE:
+            logger.warning("多進程模式下已關閉突發消息合併和 /summarize 消息記錄（需要同一群組的全部消息）")
+        logger.info("啟動 %d 個進程共用 0.0.0.0:%s（SO_REUSEPORT）", WORKERS, PORT)
+        logger.info("=" * 50)
+        PreforkServer(PORT, WORKERS, drain_timeout=float(os.getenv("DRAIN_TIMEOUT", 30))).run()
+        return
+    
+    if shard_router:
+        shard_router.start()
+    status_snapshot.start()
+    
     # 啟動Flask
-    logger.info(f"啟動Flask服務在 0.0.0.0:{PORT}")
+    logger.info("啟動Flask服務在 0.0.0.0:%s", PORT)
     logger.info("=" * 50)
     
     try:
         # 根據環境選擇運行模式
-        if DOMAIN:
+        if serving:
             # Webhook模式
             app.run(host="0.0.0.0", port=PORT, debug=False)
         else:
-            # 輪詢模式（測試用）
+            # 輪詢模式（測試用）：使用 telebot 自帶的線程池
             logger.warning("使用輪詢模式（僅測試）")
+            bot.threaded = True
+            bot.worker_pool = telebot.util.ThreadPool(bot, num_threads=WORKER_THREADS)
             bot.remove_webhook()
             bot.polling(none_stop=True, interval=1, timeout=30)
             
     except KeyboardInterrupt:
         logger.info("收到停止信號，關閉機器人...")
     except Exception as e:
-        logger.error(f"運行錯誤: {e}")
+        logger.error("運行錯誤: %s", e)
         sys.exit(1)
 
 if __name__ == "__main__":